@@ -0,0 +1,462 @@
+"""Connection-capacity benchmark: sync (WSGI) vs ASGI serving of the webapp.
+
+Starts the webapp in a subprocess in each serving mode:
+  - sync: Gunicorn sync workers running webapp.app:app (or, with
+    --sync-server werkzeug, the threaded Werkzeug development server),
+  - asgi: Uvicorn running webapp.asgi:app,
+then opens increasing numbers of slow clients against it - downloaders that
+read a large cached file at --read-rate, or uploaders that send their body at
+that rate - and, while they are connected, measures:
+  - how many slow downloads are being served (response started),
+  - latency of quick requests to / made alongside them,
+  - the server's resident memory, processes and threads.
+
+Usage (from the repository root):
+    python benchmarks/connection_capacity.py --levels 50,200,1000 \\
+        --kind download --output capacity.json
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+
+from e2e_benchmark import REPO_ROOT, parse_size, summarize, git_revision
+
+BOUNDARY = "capacity-benchmark"
+
+
+# --- Test Data ---
+
+
+def prepare_state(workdir, file_size, num_tokens):
+    """Creates a database with one large cached upload and num_tokens upload tokens."""
+    os.environ.update(
+        {
+            "DATABASE_PATH": os.path.join(workdir, "database", "metadata.db"),
+            "CACHE_DIR": os.path.join(workdir, "pending_uploads"),
+            "PREVIEW_DIR": os.path.join(workdir, "previews"),
+        }
+    )
+    os.makedirs(os.environ["CACHE_DIR"], exist_ok=True)
+    sys.path.append(REPO_ROOT)
+    import webapp.database as db
+
+    db.init_db()
+    context = {"user_id": 1, "channel_id": 1, "guild_id": 1}
+    file_id = "capacity-benchmark-file"
+    cached_path = os.path.join(os.environ["CACHE_DIR"], f"{file_id}_large.bin")
+    with open(cached_path, "wb") as f:
+        block = os.urandom(1024 * 1024)
+        for _ in range(file_size // len(block)):
+            f.write(block)
+        f.write(block[: file_size % len(block)])
+    db.add_upload_record(
+        file_id,
+        "large.bin",
+        cached_path,
+        context,
+        "application/octet-stream",
+        file_size,
+    )
+    tokens = [f"capacity-token-{i}" for i in range(num_tokens)]
+    for token in tokens:
+        db.add_upload_token(token, context)
+    return file_id, tokens
+
+
+# --- Server Under Test ---
+
+
+def server_command(mode, port, args):
+    if mode == "asgi":
+        return [
+            sys.executable,
+            "-m",
+            "uvicorn",
+            "webapp.asgi:app",
+            "--host=127.0.0.1",
+            f"--port={port}",
+            "--backlog=4096",
+            "--log-level=warning",
+            "--no-access-log",
+        ]
+    if args.sync_server == "gunicorn":
+        return [
+            sys.executable,
+            "-m",
+            "gunicorn",
+            f"--workers={args.workers}",
+            f"--bind=127.0.0.1:{port}",
+            "--backlog=4096",
+            "--timeout=300",
+            "--log-level=warning",
+            "webapp.app:app",
+        ]
+    return [
+        sys.executable,
+        "-c",
+        "import logging; logging.getLogger('werkzeug').setLevel(logging.ERROR); "
+        "from webapp.app import app; "
+        f"app.run(host='127.0.0.1', port={port}, threaded=True)",
+    ]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(mode, args, log_file):
+    port = free_port()
+    env = dict(os.environ, DOWNLOAD_MAX_STREAMS_PER_IP="0", PYTHONPATH=REPO_ROOT)
+    process = subprocess.Popen(
+        server_command(mode, port, args),
+        cwd=REPO_ROOT,
+        env=env,
+        stdout=log_file,
+        stderr=subprocess.STDOUT,
+    )
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{mode} server exited with code {process.returncode}")
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1):
+                return process, port
+        except OSError:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError(f"{mode} server did not start")
+
+
+def stop_server(process):
+    process.terminate()
+    try:
+        process.wait(timeout=15)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def process_tree_stats(root_pid):
+    """Sums resident memory and threads over a process and its children."""
+    parents = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                parents[int(entry)] = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+    tree = {root_pid}
+    changed = True
+    while changed:
+        children = {pid for pid, ppid in parents.items() if ppid in tree} - tree
+        tree |= children
+        changed = bool(children)
+    rss_kib = threads = 0
+    for pid in tree:
+        try:
+            with open(f"/proc/{pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        rss_kib += int(line.split()[1])
+                    elif line.startswith("Threads:"):
+                        threads += int(line.split()[1])
+        except OSError:
+            continue
+    return {
+        "server_processes": len(tree),
+        "server_threads": threads,
+        "server_rss_mib": round(rss_kib / 1024, 1),
+    }
+
+
+# --- Clients ---
+
+
+async def open_slow_connection(port):
+    # A small receive buffer, so a slow reader pushes back on the server quickly
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 16 * 1024)
+    sock.setblocking(False)
+    await asyncio.get_running_loop().sock_connect(sock, ("127.0.0.1", port))
+    return await asyncio.open_connection(sock=sock, limit=16 * 1024)
+
+
+class SlowClients:
+    """Keeps slow downloads or uploads going until stop() is called."""
+
+    def __init__(self, port, kind, file_id, tokens, read_rate):
+        self.port = port
+        self.kind = kind
+        self.file_id = file_id
+        self.tokens = tokens
+        self.read_rate = read_rate
+        self.stopping = asyncio.Event()
+        self.connected = 0
+        self.responding = 0
+        self.failed = 0
+        self.bytes_moved = 0
+        self.tasks = []
+
+    def start(self, count):
+        self.tasks = [
+            asyncio.create_task(self._run(self.tokens[i % len(self.tokens)]))
+            for i in range(count)
+        ]
+
+    async def stop(self):
+        self.stopping.set()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    async def _run(self, token):
+        try:
+            reader, writer = await open_slow_connection(self.port)
+        except OSError:
+            self.failed += 1
+            return
+        self.connected += 1
+        try:
+            if self.kind == "download":
+                await self._download(reader, writer)
+            else:
+                await self._upload(reader, writer, token)
+        except (OSError, asyncio.IncompleteReadError):
+            if not self.stopping.is_set():
+                self.failed += 1
+        finally:
+            writer.transport.abort()
+
+    async def _download(self, reader, writer):
+        writer.write(
+            f"GET /download/{self.file_id} HTTP/1.1\r\n"
+            f"Host: 127.0.0.1\r\nConnection: close\r\n\r\n".encode()
+        )
+        await writer.drain()
+        status_line = await self._until_stopped(reader.readline())
+        if not status_line:
+            return
+        self.responding += 1
+        while not self.stopping.is_set():
+            data = await reader.read(self.read_rate // 10)
+            if not data:
+                return
+            self.bytes_moved += len(data)
+            await self._until_stopped(asyncio.sleep(0.1))
+
+    async def _upload(self, reader, writer, token):
+        # The body never completes: the client keeps trickling it until stopped
+        size = 1024**3
+        head = (
+            f'--{BOUNDARY}\r\nContent-Disposition: form-data; name="file"; '
+            f'filename="slow.bin"\r\nContent-Type: application/octet-stream\r\n\r\n'
+        ).encode()
+        writer.write(
+            f"POST /upload/{token} HTTP/1.1\r\nHost: 127.0.0.1\r\nConnection: close\r\n"
+            f"Content-Type: multipart/form-data; boundary={BOUNDARY}\r\n"
+            f"Content-Length: {len(head) + size}\r\n\r\n".encode() + head
+        )
+        chunk = b"\0" * (self.read_rate // 10)
+        while not self.stopping.is_set():
+            writer.write(chunk)
+            await writer.drain()
+            self.bytes_moved += len(chunk)
+            await self._until_stopped(asyncio.sleep(0.1))
+
+    async def _until_stopped(self, awaitable):
+        task = asyncio.ensure_future(awaitable)
+        stopper = asyncio.ensure_future(self.stopping.wait())
+        await asyncio.wait({task, stopper}, return_when=asyncio.FIRST_COMPLETED)
+        stopper.cancel()
+        if not task.done():
+            task.cancel()
+            return None
+        return task.result()
+
+
+async def probe(port, timeout):
+    """Times one quick request to the index page. Returns seconds, or None on failure."""
+    start = time.perf_counter()
+    try:
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection("127.0.0.1", port), timeout
+        )
+        try:
+            writer.write(b"GET / HTTP/1.0\r\nHost: 127.0.0.1\r\n\r\n")
+            response = await asyncio.wait_for(reader.read(), timeout)
+        finally:
+            writer.transport.abort()
+    except (OSError, asyncio.TimeoutError):
+        return None
+    if not response.startswith(b"HTTP/1.1 200") and not response.startswith(
+        b"HTTP/1.0 200"
+    ):
+        return None
+    return time.perf_counter() - start
+
+
+async def run_level(port, server_pid, count, args, file_id, tokens):
+    clients = SlowClients(port, args.kind, file_id, tokens, args.read_rate)
+    clients.start(count)
+    await asyncio.sleep(args.hold)
+    latencies = []
+    errors = 0
+    for _ in range(args.probes):
+        latency = await probe(port, args.probe_timeout)
+        if latency is None:
+            errors += 1
+        else:
+            latencies.append(latency)
+    result = {
+        "clients": count,
+        "connected": clients.connected,
+        "connect_failed": clients.failed,
+        "probe": dict(summarize(latencies), errors=errors),
+    }
+    if args.kind == "download":
+        result["responding"] = clients.responding
+    result.update(process_tree_stats(server_pid))
+    elapsed = args.hold + sum(latencies) + errors * args.probe_timeout
+    result["client_mib_per_s"] = round(clients.bytes_moved / elapsed / 1024**2, 2)
+    await clients.stop()
+    return result
+
+
+def run(args):
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    needed = max(args.levels) * 2 + 256
+    if soft < needed:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (min(hard, needed), hard))
+
+    workdir = tempfile.mkdtemp(prefix="nas-share-capacity-")
+    file_id, tokens = prepare_state(
+        workdir, args.file_size, max(args.levels) if args.kind == "upload" else 1
+    )
+    report = {
+        "config": {
+            "modes": args.modes,
+            "sync_server": args.sync_server,
+            "workers": args.workers,
+            "levels": args.levels,
+            "kind": args.kind,
+            "file_size": args.file_size,
+            "read_rate": args.read_rate,
+            "hold_s": args.hold,
+            "probes": args.probes,
+        },
+        "environment": {
+            "git_revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        },
+        "results": {},
+    }
+    for mode in args.modes:
+        report["results"][mode] = {}
+        for count in args.levels:
+            # A fresh server per level, so one level's backlog cannot skew the next
+            with open(os.path.join(workdir, f"{mode}-server.log"), "ab") as log_file:
+                process, port = start_server(mode, args, log_file)
+            try:
+                result = asyncio.run(
+                    run_level(port, process.pid, count, args, file_id, tokens)
+                )
+            finally:
+                stop_server(process)
+            report["results"][mode][str(count)] = result
+            print_level(mode, result)
+    report["workdir"] = workdir
+    return report
+
+
+# --- Reporting ---
+
+
+def print_level(mode, result, stream=sys.stderr):
+    probe_summary = result["probe"]
+    fields = [
+        f"clients={result['clients']}",
+        f"connected={result['connected']}",
+    ]
+    if "responding" in result:
+        fields.append(f"responding={result['responding']}")
+    fields += [
+        f"probe_p50_ms={probe_summary['p50_ms']}",
+        f"probe_p99_ms={probe_summary['p99_ms']}",
+        f"probe_errors={probe_summary['errors']}",
+        f"rss_mib={result['server_rss_mib']}",
+        f"threads={result['server_threads']}",
+        f"client_mib_per_s={result['client_mib_per_s']}",
+    ]
+    print(f"  {mode:<5} " + " ".join(fields), file=stream)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--modes",
+        type=lambda text: text.split(","),
+        default=["sync", "asgi"],
+        help="Serving modes to compare (default: sync,asgi)",
+    )
+    parser.add_argument(
+        "--sync-server",
+        choices=("gunicorn", "werkzeug"),
+        default="gunicorn",
+        help="Server used for the sync mode (default: gunicorn)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=2 * (os.cpu_count() or 1) + 1,
+        help="Gunicorn sync workers (default: 2 x CPUs + 1)",
+    )
+    parser.add_argument(
+        "--levels",
+        type=lambda text: [int(level) for level in text.split(",")],
+        default=[50, 200, 1000],
+        help="Numbers of slow clients to hold open (default: 50,200,1000)",
+    )
+    parser.add_argument("--kind", choices=("download", "upload"), default="download")
+    parser.add_argument("--file-size", type=parse_size, default=parse_size("64MiB"))
+    parser.add_argument(
+        "--read-rate",
+        type=parse_size,
+        default=parse_size("16KiB"),
+        help="Bytes per second each slow client reads or sends (default: 16KiB)",
+    )
+    parser.add_argument(
+        "--hold",
+        type=float,
+        default=5,
+        help="Seconds the slow clients run before probing",
+    )
+    parser.add_argument("--probes", type=int, default=20)
+    parser.add_argument("--probe-timeout", type=float, default=5)
+    parser.add_argument("--output", help="Write the JSON report here (default: stdout)")
+    args = parser.parse_args()
+
+    report = run(args)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,571 @@
+"""End-to-end benchmark for the webapp, uploader and bot.
+
+Runs everything in one process against throwaway state:
+  - a local WsgiDAV server standing in for the NAS,
+  - the Flask webapp on a threaded Werkzeug server,
+  - the real uploader code pointed at the local WebDAV server,
+  - the real bot notification loop with a stubbed Discord client.
+
+Usage (from the repository root):
+    python benchmarks/e2e_benchmark.py --uploads 1KiB:50,1MiB:20,32MiB:2 \\
+        --downloads 500 --concurrency 16 --output run.json
+    python benchmarks/e2e_benchmark.py --compare baseline.json run.json
+
+Results are written as JSON so runs can be diffed or compared with --compare.
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import random
+import asyncio
+import logging
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.append(REPO_ROOT)
+
+SIZE_UNITS = {"B": 1, "KiB": 1024, "MiB": 1024**2, "GiB": 1024**3}
+WEBDAV_USER = "bench"
+WEBDAV_PASS = "bench"
+
+
+# --- Helpers ---
+
+
+def parse_size(text):
+    """Parses sizes like '512', '64KiB' or '10MiB' into bytes."""
+    match = re.fullmatch(r"(\d+)\s*(B|KiB|MiB|GiB)?", text.strip())
+    if not match:
+        raise argparse.ArgumentTypeError(f"Invalid size: {text}")
+    return int(match.group(1)) * SIZE_UNITS[match.group(2) or "B"]
+
+
+def parse_upload_mix(text):
+    """Parses 'SIZE:COUNT,...' into a list of (size_bytes, count) pairs."""
+    mix = []
+    for part in text.split(","):
+        size, _, count = part.partition(":")
+        mix.append((parse_size(size), int(count or 1)))
+    return mix
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list of numbers."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def summarize(latencies, elapsed=None, num_bytes=None):
+    """Summarizes latencies (seconds) into the JSON report format."""
+    summary = {
+        "count": len(latencies),
+        "p50_ms": _ms(percentile(latencies, 50)),
+        "p90_ms": _ms(percentile(latencies, 90)),
+        "p99_ms": _ms(percentile(latencies, 99)),
+        "max_ms": _ms(max(latencies) if latencies else None),
+        "mean_ms": _ms(sum(latencies) / len(latencies) if latencies else None),
+    }
+    if elapsed:
+        summary["elapsed_s"] = round(elapsed, 3)
+        summary["ops_per_s"] = round(len(latencies) / elapsed, 2)
+        if num_bytes is not None:
+            summary["mib_per_s"] = round(num_bytes / elapsed / 1024**2, 2)
+    return summary
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 3)
+
+
+def run_concurrently(func, items, concurrency):
+    """Runs func over items with a thread pool and returns (results, elapsed)."""
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(func, items))
+    return results, time.perf_counter() - start
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=REPO_ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# --- Stand-in Services ---
+
+
+def start_webdav_server(nas_dir):
+    """Starts a local WsgiDAV server serving nas_dir and returns its base URL."""
+    try:
+        from cheroot import wsgi
+        from wsgidav.wsgidav_app import WsgiDAVApp
+    except ImportError:
+        print(
+            "Error: the benchmark needs wsgidav and cheroot "
+            "(pip install -r benchmarks/requirements.txt)."
+        )
+        sys.exit(1)
+    config = {
+        "provider_mapping": {"/": nas_dir},
+        "simple_dc": {"user_mapping": {"*": {WEBDAV_USER: {"password": WEBDAV_PASS}}}},
+        "http_authenticator": {
+            "accept_basic": True,
+            "accept_digest": False,
+            "default_to_digest": False,
+        },
+        "verbose": 0,
+        "logging": {"enable": False},
+    }
+    server = wsgi.Server(("127.0.0.1", 0), WsgiDAVApp(config), numthreads=16)
+    server.prepare()
+    threading.Thread(target=server.serve, daemon=True).start()
+    return f"http://127.0.0.1:{server.bind_addr[1]}", server
+
+
+def start_webapp_server(app):
+    """Serves the Flask app on a threaded Werkzeug server and returns its base URL."""
+    from werkzeug.serving import make_server
+
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}", server
+
+
+class FakeChannel:
+    """Stands in for a Discord channel and records when each link is posted."""
+
+    def __init__(self, posted):
+        self.posted = posted
+
+    async def send(self, message, embed=None):
+        match = re.search(r"/download/([0-9a-f-]+)", message)
+        if match:
+            self.posted[match.group(1)] = time.time()
+
+
+class FakeResponse:
+    def __init__(self):
+        self.message = None
+
+    async def send_message(self, content, ephemeral=False):
+        self.message = content
+
+
+class FakeInteraction:
+    """The parts of discord.Interaction used by the /upload command."""
+
+    def __init__(self, user_id, channel_id):
+        self.user = type("FakeUser", (), {"id": user_id, "name": f"user{user_id}"})
+        self.channel_id = channel_id
+        self.guild_id = 1
+        self.response = FakeResponse()
+
+
+class FakeBot:
+    """Runs the real bot notification loop with Discord calls stubbed out."""
+
+    def __init__(self, bot_module, interval):
+        self.bot_module = bot_module
+        self.interval = interval
+        self.posted = {}
+        self.loop = asyncio.new_event_loop()
+        self.stopping = False
+        channel = FakeChannel(self.posted)
+
+        async def fetch_channel(channel_id):
+            return channel
+
+        bot_module.bot.fetch_channel = fetch_channel
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(self._poll())
+
+    async def _poll(self):
+        while not self.stopping:
+            await self.bot_module.check_notifications_task.coro()
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopping = True
+        self.thread.join(timeout=self.interval * 5)
+
+    def issue_token(self, user_id):
+        """Runs the /upload command and returns the upload URL it replied with."""
+        interaction = FakeInteraction(user_id, channel_id=1000 + user_id % 4)
+        future = asyncio.run_coroutine_threadsafe(
+            self.bot_module.upload_command.callback(interaction), self.loop
+        )
+        future.result()
+        match = re.search(r"<(\S+/upload/\S+)>", interaction.response.message or "")
+        return match.group(1) if match else None
+
+
+# --- Benchmark Phases ---
+
+
+class Benchmark:
+    def __init__(self, args, session_factory):
+        self.args = args
+        self.session_factory = session_factory
+        self._local = threading.local()
+        self.payloads = {}
+        self.uploaded_at = {}  # file_id -> wall clock time the upload returned
+        self.replicated_at = {}  # file_id -> wall clock time status became on_nas
+
+    @property
+    def session(self):
+        # requests.Session is not thread-safe; keep one per worker thread
+        if not hasattr(self._local, "session"):
+            self._local.session = self.session_factory()
+        return self._local.session
+
+    def payload(self, size):
+        if size not in self.payloads:
+            self.payloads[size] = os.urandom(size)
+        return self.payloads[size]
+
+    def issue_tokens(self, fake_bot, count):
+        def issue(user_id):
+            start = time.perf_counter()
+            url = fake_bot.issue_token(user_id)
+            return url, time.perf_counter() - start
+
+        results, elapsed = run_concurrently(issue, range(count), self.args.concurrency)
+        urls = [url for url, _ in results if url]
+        return urls, summarize([lat for _, lat in results], elapsed)
+
+    def upload_batch(self, upload_urls, sizes):
+        def upload(item):
+            url, size = item
+            start = time.perf_counter()
+            response = self.session.post(
+                url, files={"file": (f"bench-{size}.bin", self.payload(size))}
+            )
+            latency = time.perf_counter() - start
+            match = re.search(r"File ID: ([0-9a-f-]+)", response.text)
+            if response.status_code != 200 or not match:
+                return None, latency, size
+            self.uploaded_at[match.group(1)] = time.time()
+            return match.group(1), latency, size
+
+        results, elapsed = run_concurrently(
+            upload, list(zip(upload_urls, sizes)), self.args.concurrency
+        )
+        ok = [r for r in results if r[0]]
+        summary = summarize(
+            [lat for _, lat, _ in ok], elapsed, sum(size for _, _, size in ok)
+        )
+        summary["errors"] = len(results) - len(ok)
+        by_size = {}
+        for _, lat, size in ok:
+            by_size.setdefault(size, []).append(lat)
+        summary["by_size"] = {
+            str(size): summarize(lats) for size, lats in sorted(by_size.items())
+        }
+        return [file_id for file_id, _, _ in ok], summary
+
+    def replicate(self, uploader_module, db_module, file_ids):
+        """Runs one uploader pass while watching for each file to reach the NAS."""
+        done = threading.Event()
+
+        def watch():
+            pending = set(file_ids)
+            while pending and not done.is_set():
+                for file_id in list(pending):
+                    record = db_module.get_upload_record(file_id)
+                    if record and record["status"] == "on_nas":
+                        self.replicated_at[file_id] = time.time()
+                        pending.discard(file_id)
+                time.sleep(0.01)
+
+        watcher = threading.Thread(target=watch, daemon=True)
+        watcher.start()
+        start = time.perf_counter()
+        uploader_module.upload_pending_files()
+        elapsed = time.perf_counter() - start
+        watcher.join(timeout=2)
+        done.set()
+        num_bytes = sum(
+            db_module.get_upload_record(file_id)["file_size"] or 0
+            for file_id in file_ids
+            if file_id in self.replicated_at
+        )
+        latencies = [
+            self.replicated_at[f] - self.uploaded_at[f]
+            for f in file_ids
+            if f in self.replicated_at
+        ]
+        summary = summarize(latencies, elapsed, num_bytes)
+        summary["errors"] = len(file_ids) - len(latencies)
+        return summary
+
+    def wait_for_notifications(self, fake_bot, file_ids, timeout):
+        deadline = time.time() + timeout
+        while time.time() < deadline and not all(
+            f in fake_bot.posted for f in file_ids
+        ):
+            time.sleep(0.05)
+        latencies = [
+            fake_bot.posted[f] - self.uploaded_at[f]
+            for f in file_ids
+            if f in fake_bot.posted
+        ]
+        summary = summarize(latencies)
+        summary["missing"] = len(file_ids) - len(latencies)
+        return summary
+
+    def download(self, base_url, cached_ids, nas_ids, count):
+        rng = random.Random(self.args.seed)
+        pools = [("cache", cached_ids), ("nas", nas_ids)]
+        pools = [(name, ids) for name, ids in pools if ids]
+        work = []
+        for _ in range(count):
+            name, ids = pools[
+                0 if rng.random() >= self.args.nas_fraction else len(pools) - 1
+            ]
+            work.append((name, rng.choice(ids)))
+
+        def fetch(item):
+            source, file_id = item
+            start = time.perf_counter()
+            response = self.session.get(f"{base_url}/download/{file_id}")
+            num_bytes = len(response.content)
+            return source, response.status_code, time.perf_counter() - start, num_bytes
+
+        results, elapsed = run_concurrently(fetch, work, self.args.concurrency)
+        report = {
+            "all": summarize(
+                [lat for _, _, lat, _ in results],
+                elapsed,
+                sum(n for _, _, _, n in results),
+            )
+        }
+        for source, _ in pools:
+            subset = [r for r in results if r[0] == source]
+            report[source] = summarize(
+                [lat for _, _, lat, _ in subset],
+                elapsed,
+                sum(n for _, _, _, n in subset),
+            )
+            report[source]["errors"] = sum(1 for r in subset if r[1] != 200)
+        return report
+
+
+def run(args):
+    workdir = tempfile.mkdtemp(prefix="nas-share-bench-")
+    nas_dir = os.path.join(workdir, "nas")
+    # The NAS share folder normally exists already
+    os.makedirs(os.path.join(nas_dir, "DiscordUploads"))
+    # Every service reads its configuration at import time
+    os.environ.update(
+        {
+            "DATABASE_PATH": os.path.join(workdir, "database", "metadata.db"),
+            "CACHE_DIR": os.path.join(workdir, "pending_uploads"),
+            "PREVIEW_DIR": os.path.join(workdir, "previews"),
+            "NAS_WEBDAV_USER": WEBDAV_USER,
+            "NAS_WEBDAV_PASS": WEBDAV_PASS,
+            "NAS_TARGET_FOLDER": "/DiscordUploads",
+            "DISCORD_BOT_TOKEN": "benchmark-token",
+            "UPLOADER_METRICS_PORT": "0",
+            "BOT_METRICS_PORT": "0",
+            "NAS_BACKEND": args.storage,
+            "NAS_LOCAL_PATH": nas_dir,
+        }
+    )
+    webdav_server = None
+    if args.storage == "webdav":
+        webdav_url, webdav_server = start_webdav_server(nas_dir)
+        os.environ["NAS_WEBDAV_URL"] = webdav_url
+
+    import requests
+    import webapp.app as webapp_module
+    import webapp.database as db_module
+
+    base_url, webapp_server = start_webapp_server(webapp_module.app)
+    os.environ["FLASK_APP_BASE_URL"] = base_url
+    import bot.bot as bot_module
+    import uploader.uploader as uploader_module
+
+    logging.getLogger().setLevel(logging.WARNING)
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    webapp_module.app.logger.setLevel(logging.WARNING)
+
+    fake_bot = FakeBot(bot_module, args.bot_interval)
+    fake_bot.start()
+    bench = Benchmark(args, requests.Session)
+
+    sizes = [size for size, count in args.uploads for _ in range(count)]
+    random.Random(args.seed).shuffle(sizes)
+    cached_sizes = sizes[: max(1, int(len(sizes) * args.cached_fraction))]
+    replicated_sizes = sizes[len(cached_sizes) :]
+    report = {
+        "config": {
+            "uploads": [[size, count] for size, count in args.uploads],
+            "downloads": args.downloads,
+            "concurrency": args.concurrency,
+            "cached_fraction": args.cached_fraction,
+            "nas_fraction": args.nas_fraction,
+            "storage": args.storage,
+            "bot_interval_s": args.bot_interval,
+            "seed": args.seed,
+        },
+        "environment": {
+            "git_revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        },
+        "results": {},
+    }
+    results = report["results"]
+
+    # 1. Token issuing through the real /upload command
+    upload_urls, results["token_issue"] = bench.issue_tokens(fake_bot, len(sizes))
+
+    # 2. Uploads that will be replicated to the NAS, then one uploader pass
+    nas_ids, results["upload_replicated"] = bench.upload_batch(
+        upload_urls[: len(replicated_sizes)], replicated_sizes
+    )
+    results["replication"] = bench.replicate(uploader_module, db_module, nas_ids)
+
+    # 3. Uploads that stay in the cache
+    cached_ids, results["upload_cached"] = bench.upload_batch(
+        upload_urls[len(replicated_sizes) :], cached_sizes
+    )
+    results["notification"] = bench.wait_for_notifications(
+        fake_bot, nas_ids + cached_ids, args.notification_timeout
+    )
+
+    # 4. Concurrent mix of cached and NAS-fallback downloads
+    results["download"] = bench.download(base_url, cached_ids, nas_ids, args.downloads)
+    fake_bot.stop()
+    webapp_server.shutdown()
+    if webdav_server:
+        webdav_server.stop()
+    report["workdir"] = workdir
+    return report
+
+
+# --- Reporting ---
+
+
+def print_summary(report, stream=sys.stderr):
+    def line(name, summary):
+        fields = [f"n={summary.get('count')}"]
+        for key in ("p50_ms", "p99_ms", "ops_per_s", "mib_per_s", "errors", "missing"):
+            if summary.get(key) is not None:
+                fields.append(f"{key}={summary[key]}")
+        print(f"  {name:<22} " + " ".join(fields), file=stream)
+
+    print(f"Benchmark ({report['environment']['git_revision']}):", file=stream)
+    for name, summary in report["results"].items():
+        if name == "download":
+            for source, sub in summary.items():
+                line(f"download.{source}", sub)
+        else:
+            line(name, summary)
+
+
+def flatten(results, prefix=""):
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)):
+            flat[f"{prefix}{key}"] = value
+    return flat
+
+
+def compare(baseline_path, candidate_path):
+    """Prints the change in every latency and throughput figure between two runs."""
+    with open(baseline_path) as f:
+        baseline = flatten(json.load(f)["results"])
+    with open(candidate_path) as f:
+        candidate = flatten(json.load(f)["results"])
+    for key in sorted(baseline.keys() & candidate.keys()):
+        if not key.endswith(("_ms", "_per_s")):
+            continue
+        old, new = baseline[key], candidate[key]
+        change = f"{(new - old) / old * 100:+.1f}%" if old else "n/a"
+        print(f"{key:<50} {old:>12} -> {new:>12}  {change}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--uploads",
+        type=parse_upload_mix,
+        default=parse_upload_mix("1KiB:40,1MiB:16,16MiB:4"),
+        help="Upload mix as SIZE:COUNT pairs (default: 1KiB:40,1MiB:16,16MiB:4)",
+    )
+    parser.add_argument("--downloads", type=int, default=400)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument(
+        "--cached-fraction",
+        type=float,
+        default=0.5,
+        help="Fraction of uploads kept in the cache instead of replicated",
+    )
+    parser.add_argument(
+        "--nas-fraction",
+        type=float,
+        default=0.5,
+        help="Fraction of downloads that hit NAS-fallback files",
+    )
+    parser.add_argument(
+        "--storage",
+        choices=("webdav", "local"),
+        default="webdav",
+        help="NAS backend: a local WsgiDAV server, or a plain directory (default: webdav)",
+    )
+    parser.add_argument("--bot-interval", type=float, default=0.25)
+    parser.add_argument("--notification-timeout", type=float, default=30)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="Write the JSON report here (default: stdout)")
+    parser.add_argument(
+        "--compare",
+        nargs=2,
+        metavar=("BASELINE", "CANDIDATE"),
+        help="Compare two JSON reports instead of running",
+    )
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    report = run(args)
+    print_summary(report)
+    payload = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(payload + "\n")
+    else:
+        print(payload)
+
+
+if __name__ == "__main__":
+    main()
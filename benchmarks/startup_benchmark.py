@@ -0,0 +1,294 @@
+"""Startup benchmark: import time, first database access and time-to-ready.
+
+Every measurement runs in a fresh Python process against throwaway state:
+  - import time of each service module (webapp, ASGI entry point, uploader, bot),
+  - time to the first query in a new process, against a new database (the
+    schema is created) and against an existing one,
+  - time from launching the webapp server until it answers GET /, with the
+    number of times the schema DDL ran across its processes.
+
+Usage (from the repository root):
+    python benchmarks/startup_benchmark.py --output startup.json
+    git worktree add /tmp/baseline <rev>
+    python benchmarks/startup_benchmark.py --source /tmp/baseline --output baseline.json
+    python benchmarks/startup_benchmark.py --compare baseline.json startup.json
+"""
+
+import os
+import sys
+import time
+import json
+import socket
+import argparse
+import platform
+import tempfile
+import subprocess
+import importlib.util
+
+from e2e_benchmark import REPO_ROOT, summarize, git_revision, compare
+
+MODULES = [
+    "webapp.database",
+    "webapp.app",
+    "webapp.asgi",
+    "uploader.uploader",
+    "bot.bot",
+]
+TIMED_IMPORT = (
+    "import time; start = time.perf_counter(); import {module}; "
+    "print(time.perf_counter() - start)"
+)
+TIMED_FIRST_QUERY = (
+    "import webapp.database as db, time; start = time.perf_counter(); "
+    "db.get_token_context('startup-benchmark'); print(time.perf_counter() - start)"
+)
+SCHEMA_INIT_MARKER = b"Database initialized"
+
+
+def service_env(source, workdir):
+    return dict(
+        os.environ,
+        PYTHONPATH=source,
+        DATABASE_PATH=os.path.join(workdir, "database", "metadata.db"),
+        CACHE_DIR=os.path.join(workdir, "pending_uploads"),
+        PREVIEW_DIR=os.path.join(workdir, "previews"),
+        DISCORD_BOT_TOKEN="benchmark-token",
+        FLASK_APP_BASE_URL="http://127.0.0.1:5000",
+        UPLOADER_METRICS_PORT="0",
+        BOT_METRICS_PORT="0",
+    )
+
+
+def run_timed(code, source, env):
+    """Runs code in a fresh interpreter; returns (seconds it printed, output)."""
+    result = subprocess.run(
+        [sys.executable, "-c", code],
+        cwd=source,
+        env=env,
+        capture_output=True,
+        check=True,
+    )
+    return float(result.stdout.splitlines()[-1]), result.stdout + result.stderr
+
+
+# --- Measurements ---
+
+
+def measure_imports(source, workdir, repeats):
+    env = service_env(source, workdir)
+    # Start from an existing, up-to-date database, as a restart would
+    run_timed(TIMED_FIRST_QUERY, source, env)
+    results = {}
+    for module in MODULES:
+        timings = [
+            run_timed(TIMED_IMPORT.format(module=module), source, env)[0]
+            for _ in range(repeats)
+        ]
+        results[module] = summarize(timings)
+    return results
+
+
+def measure_first_query(source, workdir, repeats):
+    new_db, existing_db = [], []
+    for i in range(repeats):
+        env = service_env(source, os.path.join(workdir, f"first-query-{i}"))
+        new_db.append(run_timed(TIMED_FIRST_QUERY, source, env)[0])
+        existing_db.append(run_timed(TIMED_FIRST_QUERY, source, env)[0])
+    return {
+        "new_database": summarize(new_db),
+        "existing_database": summarize(existing_db),
+    }
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def server_command(server, port, workers):
+    if server == "gunicorn":
+        return [
+            sys.executable,
+            "-m",
+            "gunicorn",
+            f"--workers={workers}",
+            f"--bind=127.0.0.1:{port}",
+            "webapp.app:app",
+        ]
+    return [
+        sys.executable,
+        "-m",
+        "uvicorn",
+        "webapp.asgi:app",
+        "--host=127.0.0.1",
+        f"--port={port}",
+        f"--workers={workers}",
+    ]
+
+
+def wait_for_index(port, process, timeout):
+    request = b"GET / HTTP/1.0\r\nHost: 127.0.0.1\r\n\r\n"
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            return False
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1) as sock:
+                sock.sendall(request)
+                if sock.recv(64).split(b" ", 2)[1:2] == [b"200"]:
+                    return True
+        except (OSError, IndexError):
+            pass
+        time.sleep(0.01)
+    return False
+
+
+def measure_time_to_ready(source, workdir, server, workers, repeats):
+    """Times launching the webapp server until GET / returns 200."""
+    env = service_env(source, workdir)
+    run_timed(TIMED_FIRST_QUERY, source, env)  # An existing database, as on a restart
+    timings, schema_inits = [], []
+    for _ in range(repeats):
+        port = free_port()
+        log_path = os.path.join(workdir, f"{server}.log")
+        with open(log_path, "wb") as log_file:
+            start = time.perf_counter()
+            process = subprocess.Popen(
+                server_command(server, port, workers),
+                cwd=source,
+                env=env,
+                stdout=log_file,
+                stderr=subprocess.STDOUT,
+            )
+            try:
+                if wait_for_index(port, process, timeout=60):
+                    timings.append(time.perf_counter() - start)
+                # Let the remaining workers finish booting before counting
+                time.sleep(2)
+            finally:
+                process.terminate()
+                process.wait(timeout=15)
+        with open(log_path, "rb") as f:
+            schema_inits.append(f.read().count(SCHEMA_INIT_MARKER))
+    summary = summarize(timings)
+    summary["errors"] = repeats - len(timings)
+    summary["schema_inits_per_start"] = max(schema_inits)
+    return summary
+
+
+def run(args):
+    source = os.path.abspath(args.source)
+    workdir = tempfile.mkdtemp(prefix="nas-share-startup-")
+    report = {
+        "config": {
+            "source": source,
+            "repeats": args.repeats,
+            "servers": args.servers,
+            "workers": args.workers,
+        },
+        "environment": {
+            "git_revision": git_revision_of(source),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        },
+        "results": {},
+    }
+    results = report["results"]
+    results["import"] = measure_imports(
+        source, os.path.join(workdir, "imports"), args.repeats
+    )
+    results["first_query"] = measure_first_query(
+        source, os.path.join(workdir, "first-query"), args.repeats
+    )
+    results["time_to_ready"] = {}
+    for server in args.servers:
+        if importlib.util.find_spec(server) is None:
+            print(f"Skipping {server}: not installed", file=sys.stderr)
+            continue
+        results["time_to_ready"][server] = measure_time_to_ready(
+            source,
+            os.path.join(workdir, f"ready-{server}"),
+            server,
+            args.workers,
+            args.repeats,
+        )
+    report["workdir"] = workdir
+    return report
+
+
+def git_revision_of(source):
+    if os.path.samefile(source, REPO_ROOT):
+        return git_revision()
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=source,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# --- Reporting ---
+
+
+def print_summary(report, stream=sys.stderr):
+    print(f"Startup ({report['environment']['git_revision']}):", file=stream)
+    for group, entries in report["results"].items():
+        for name, summary in entries.items():
+            fields = [f"p50_ms={summary['p50_ms']}", f"max_ms={summary['max_ms']}"]
+            for key in ("errors", "schema_inits_per_start"):
+                if key in summary:
+                    fields.append(f"{key}={summary[key]}")
+            print(f"  {group + '.' + name:<36} " + " ".join(fields), file=stream)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--source",
+        default=REPO_ROOT,
+        help="Repository checkout to measure (default: this one)",
+    )
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument(
+        "--servers",
+        type=lambda text: text.split(","),
+        default=["gunicorn", "uvicorn"],
+        help="Webapp servers to time to ready (default: gunicorn,uvicorn)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=4,
+        help="Worker processes per server (default: 4)",
+    )
+    parser.add_argument("--output", help="Write the JSON report here (default: stdout)")
+    parser.add_argument(
+        "--compare",
+        nargs=2,
+        metavar=("BASELINE", "CANDIDATE"),
+        help="Compare two JSON reports instead of running",
+    )
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    report = run(args)
+    print_summary(report)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,29 @@
 import os
+import re
+import json
+import time
+
+# Measured from here, so time-to-ready covers the imports below and login
+START_TIME = time.monotonic()
+
+import asyncio
+import hashlib
 import discord
 from discord import app_commands
 from discord.ext import commands, tasks
 import uuid
 import logging
+from datetime import datetime, timezone
+from typing import Optional
 from dotenv import load_dotenv
+from prometheus_client import Counter, Gauge, Histogram
 import sys
 
 # Add the parent directory to sys.path to allow importing webapp.database
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 try:
     import webapp.database as db
+    import webapp.metrics as metrics
 except ImportError:
     print("Error: Could not import database module. Make sure it's accessible.")
     sys.exit(1)
@@ -26,6 +39,11 @@ TARGET_CHANNEL_IDS = (
     if TARGET_CHANNEL_IDS_STR
     else None
 )
+BOT_METRICS_PORT = int(os.getenv("BOT_METRICS_PORT", 9102))  # 0 disables
+# How long a completion message is held back while its preview is being made
+PREVIEW_NOTIFY_WAIT_SECONDS = int(os.getenv("PREVIEW_NOTIFY_WAIT_SECONDS", 30))
+# service_state key holding the hash of the last command tree synced to Discord
+COMMAND_TREE_HASH_KEY = "bot_command_tree_hash"
 
 if not BOT_TOKEN:
     print("Error: DISCORD_BOT_TOKEN not found in .env file.")
@@ -40,6 +58,23 @@ logging.basicConfig(
 )
 logger = logging.getLogger("discord_bot")
 
+# --- Metrics ---
+NOTIFICATION_BACKLOG = Gauge(
+    "bot_notification_backlog", "Pending notifications seen at the last poll."
+)
+NOTIFICATION_LATENCY = Histogram(
+    "bot_notification_latency_seconds",
+    "Time from a notification being queued by the webapp until it is posted to Discord.",
+    buckets=metrics.DELAY_BUCKETS,
+)
+NOTIFICATIONS_TOTAL = Counter(
+    "bot_notifications_total", "Processed notifications.", ["outcome"]
+)
+TIME_TO_READY = Gauge(
+    "bot_time_to_ready_seconds",
+    "Time from process start until the first gateway READY.",
+)
+
 # --- Bot Setup ---
 intents = discord.Intents.default()
 # No special intents needed for slash commands usually, but add if required later
@@ -48,6 +83,7 @@ intents = discord.Intents.default()
 bot = commands.Bot(
     command_prefix="!", intents=intents
 )  # Prefix not really used for slash commands
+ready_at = None  # Monotonic time of the first on_ready
 
 
 # --- Helper Functions ---
@@ -56,22 +92,56 @@ def generate_upload_token():
     return str(uuid.uuid4())
 
 
+def command_tree_hash():
+    """Hashes the payload tree.sync() would upload, plus the application it is for."""
+    payload = [command.to_dict(bot.tree) for command in bot.tree.get_commands()]
+    payload.sort(key=lambda command: (command.get("type", 1), command["name"]))
+    data = json.dumps([bot.application_id, payload], sort_keys=True)
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+async def sync_commands():
+    """Syncs the slash commands with Discord, unless they are unchanged since the
+    last sync (syncing is slow and rate limited, and restarts rarely change them)."""
+    tree_hash = command_tree_hash()
+    if (
+        await asyncio.to_thread(db.get_service_state, COMMAND_TREE_HASH_KEY)
+        == tree_hash
+    ):
+        logger.info("Command tree unchanged since the last sync, skipping sync.")
+        return
+    try:
+        synced = await bot.tree.sync()
+    except Exception as e:
+        logger.error(f"Failed to sync commands: {e}")
+        return
+    await asyncio.to_thread(db.set_service_state, COMMAND_TREE_HASH_KEY, tree_hash)
+    logger.info(f"Synced {len(synced)} command(s)")
+
+
 # --- Events ---
+@bot.event
+async def setup_hook():
+    # Runs once per process after login, unlike on_ready which also runs
+    # after every reconnect
+    await sync_commands()
+    # Start the background task (it waits for the bot to be ready)
+    check_notifications_task.start()
+
+
 @bot.event
 async def on_ready():
+    global ready_at
+    if ready_at is None:
+        ready_at = time.monotonic()
+        TIME_TO_READY.set(ready_at - START_TIME)
+        logger.info(f"Ready {ready_at - START_TIME:.2f}s after start.")
     logger.info(f"Logged in as {bot.user.name} (ID: {bot.user.id})")
     logger.info(f"Flask App Base URL: {APP_BASE_URL}")
     if TARGET_CHANNEL_IDS:
         logger.info(f"Restricting /upload command to channel IDs: {TARGET_CHANNEL_IDS}")
     else:
         logger.info("/upload command is available in all channels.")
-    try:
-        synced = await bot.tree.sync()
-        logger.info(f"Synced {len(synced)} command(s)")
-    except Exception as e:
-        logger.error(f"Failed to sync commands: {e}")
-    # Start the background task
-    check_notifications_task.start()
 
 
 # --- Slash Commands ---
@@ -145,16 +215,227 @@ async def upload_command_error(
         )
 
 
+# --- /files Commands ---
+# Listing and search run in a worker thread (asyncio.to_thread) so SQLite never
+# blocks the event loop; pages are fetched with keyset cursors, never OFFSET.
+FILES_PAGE_SIZE = 10
+
+files_group = app_commands.Group(
+    name="files", description="List and search files shared through the bot."
+)
+
+
+def format_size(num_bytes):
+    """Formats a byte count for display (e.g. 1.5 MiB)."""
+    if num_bytes is None:
+        return "? B"
+    size = float(num_bytes)
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if size < 1024 or unit == "GiB":
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+
+
+def format_files_page(title, rows, page):
+    """Renders one page of upload rows as a Discord message."""
+    if not rows:
+        return f"**{title}**\nNo files found."
+    lines = [f"**{title}** (page {page})"]
+    for row in rows:
+        name = row["original_filename"]
+        if len(name) > 80:
+            name = name[:77] + "..."
+        link = f"{APP_BASE_URL.rstrip('/')}/download/{row['file_id']}"
+        uploaded_at = db.parse_timestamp(row["upload_timestamp"])
+        lines.append(
+            f"[{name}](<{link}>) · {format_size(row['file_size'])} · "
+            f"<@{row['context_user_id']}> · <t:{int(uploaded_at.timestamp())}:R>"
+        )
+    return "\n".join(lines)
+
+
+class FilesPageView(discord.ui.View):
+    """Keeps the keyset cursor of a listing and fetches the next page on demand."""
+
+    def __init__(self, title, fetch_page, next_cursor):
+        super().__init__(timeout=300)
+        self.title = title
+        self.fetch_page = fetch_page  # Blocking: cursor -> (rows, next_cursor)
+        self.next_cursor = next_cursor
+        self.page = 1
+
+    @discord.ui.button(label="Next page", style=discord.ButtonStyle.secondary)
+    async def next_page(
+        self, interaction: discord.Interaction, button: discord.ui.Button
+    ):
+        rows, self.next_cursor = await asyncio.to_thread(
+            self.fetch_page, self.next_cursor
+        )
+        self.page += 1
+        button.disabled = self.next_cursor is None
+        await interaction.response.edit_message(
+            content=format_files_page(self.title, rows, self.page), view=self
+        )
+
+
+async def send_files_page(interaction: discord.Interaction, title, fetch_page):
+    """Replies (ephemerally) with the first page of a listing."""
+    if TARGET_CHANNEL_IDS and interaction.channel_id not in TARGET_CHANNEL_IDS:
+        await interaction.response.send_message(
+            "Sorry, you can only use this command in specific channels.", ephemeral=True
+        )
+        return
+    rows, next_cursor = await asyncio.to_thread(fetch_page, None)
+    content = format_files_page(title, rows, 1)
+    if next_cursor is None:
+        await interaction.response.send_message(content, ephemeral=True)
+    else:
+        view = FilesPageView(title, fetch_page, next_cursor)
+        await interaction.response.send_message(content, view=view, ephemeral=True)
+
+
+@files_group.command(name="channel", description="List files shared in this channel.")
+@app_commands.describe(user="Only show files uploaded by this user")
+async def files_channel_command(
+    interaction: discord.Interaction, user: Optional[discord.User] = None
+):
+    channel_id = interaction.channel_id
+    user_id = user.id if user else None
+    title = f"Files from {user.display_name}" if user else "Files in this channel"
+    await send_files_page(
+        interaction,
+        title,
+        lambda cursor: db.list_uploads(
+            channel_id=channel_id, user_id=user_id, after=cursor, limit=FILES_PAGE_SIZE
+        ),
+    )
+
+
+@files_group.command(name="mine", description="List the files you have shared.")
+async def files_mine_command(interaction: discord.Interaction):
+    user_id = interaction.user.id
+    await send_files_page(
+        interaction,
+        "Your files",
+        lambda cursor: db.list_uploads(
+            user_id=user_id, after=cursor, limit=FILES_PAGE_SIZE
+        ),
+    )
+
+
+@files_group.command(
+    name="search", description="Search this channel's files by filename."
+)
+@app_commands.describe(query="Words (or word prefixes) in the filename")
+async def files_search_command(interaction: discord.Interaction, query: str):
+    channel_id = interaction.channel_id
+    await send_files_page(
+        interaction,
+        f"Files matching '{query[:50]}'",
+        lambda cursor: db.search_uploads(
+            query, channel_id=channel_id, after=cursor, limit=FILES_PAGE_SIZE
+        ),
+    )
+
+
+bot.tree.add_command(files_group)
+
+
+# --- /stats Command ---
+# Reads the per-file totals the webapp flushes to download_stats every few seconds
+DOWNLOAD_LINK_PATTERN = re.compile(r"/download/([\w-]+)")
+
+
+def format_last_access(value):
+    if not value:
+        return "never"
+    return f"<t:{int(db.parse_timestamp(value).timestamp())}:R>"
+
+
+def format_file_stats(row):
+    return (
+        f"**{row['original_filename']}**\n"
+        f"Downloads: {row['download_count']} ({format_size(row['bytes_served'])} served)\n"
+        f"Last downloaded: {format_last_access(row['last_access'])}"
+    )
+
+
+def format_channel_stats(totals, top):
+    lines = [
+        "**Download statistics for this channel**",
+        f"Files: {totals['uploads']} ({format_size(totals['bytes_stored'])})",
+        f"Downloads: {totals['download_count']} ({format_size(totals['bytes_served'])} served)",
+        f"Last download: {format_last_access(totals['last_access'])}",
+    ]
+    if top:
+        lines.append("Most downloaded:")
+        for rank, row in enumerate(top, start=1):
+            name = row["original_filename"]
+            if len(name) > 80:
+                name = name[:77] + "..."
+            link = f"{APP_BASE_URL.rstrip('/')}/download/{row['file_id']}"
+            lines.append(
+                f"{rank}. [{name}](<{link}>) · {row['download_count']} download(s) · "
+                f"last {format_last_access(row['last_access'])}"
+            )
+    return "\n".join(lines)
+
+
+@bot.tree.command(
+    name="stats", description="Shows download statistics for this channel or a file."
+)
+@app_commands.describe(link="A download link (or file ID) to show statistics for")
+async def stats_command(interaction: discord.Interaction, link: Optional[str] = None):
+    """Handles the /stats command."""
+    if TARGET_CHANNEL_IDS and interaction.channel_id not in TARGET_CHANNEL_IDS:
+        await interaction.response.send_message(
+            "Sorry, you can only use this command in specific channels.", ephemeral=True
+        )
+        return
+    if link:
+        match = DOWNLOAD_LINK_PATTERN.search(link)
+        file_id = match.group(1) if match else link.strip()
+        row = await asyncio.to_thread(db.get_download_stats, file_id)
+        # Only files shared in this channel; others look the same as missing ones
+        if row and row["context_channel_id"] == str(interaction.channel_id):
+            content = format_file_stats(row)
+        else:
+            content = "No file found for that link in this channel."
+    else:
+        totals, top = await asyncio.to_thread(
+            db.get_channel_download_stats, interaction.channel_id
+        )
+        if totals is None:
+            content = "Sorry, statistics are not available right now."
+        else:
+            content = format_channel_stats(totals, top)
+    await interaction.response.send_message(content, ephemeral=True)
+
+
 # --- Bot Notification Handling ---
 # Implemented using database polling via a background task.
 # Let's plan for Flask to store the completed upload info, and we'll add a mechanism
 # for the bot to be triggered later (maybe Flask writes to a simple queue file the bot watches?).
 
 
+def build_preview_embed(preview, file_id: str, original_filename: str, share_link: str):
+    """Returns an embed showing the upload's preview, or None if it has none yet."""
+    if not preview or preview["status"] != "ready":
+        return None
+    embed = discord.Embed(title=original_filename, url=share_link)
+    if preview["kind"] == "text":
+        # Keep the snippet from closing the code block early
+        snippet = preview["text"].replace("```", "`\u200b``")
+        embed.description = f"```\n{snippet[:3900]}\n```"
+    else:
+        embed.set_image(url=f"{APP_BASE_URL.rstrip('/')}/preview/{file_id}")
+    return embed
+
+
 async def send_completion_message(
-    channel_id: int, user_id: int, file_id: str, original_filename: str
+    channel_id: int, user_id: int, file_id: str, original_filename: str, preview=None
 ):
-    """Sends the final share link back to the original channel."""
+    """Sends the final share link back to the original channel. Returns True if it was sent."""
     try:
         # Ensure IDs are integers
         channel_id_int = int(channel_id)
@@ -165,10 +446,12 @@ async def send_completion_message(
             share_link = f"{APP_BASE_URL.rstrip('/')}/download/{file_id}"
             user_mention = f"<@{user_id_int}>"
             message = f"{user_mention} Your file '{original_filename}' has been uploaded successfully!\nDownload link: <{share_link}>"
-            await channel.send(message)
+            embed = build_preview_embed(preview, file_id, original_filename, share_link)
+            await channel.send(message, embed=embed)
             logger.info(
                 f"Sent completion message for file {file_id} to channel {channel_id_int}"
             )
+            return True
         else:
             logger.error(
                 f"Could not find channel {channel_id_int} to send completion message."
@@ -183,6 +466,7 @@ async def send_completion_message(
         logger.error(
             f"Error sending completion message for file {file_id}: {e}", exc_info=True
         )
+    return False
 
 
 # --- Background Task for Notifications ---
@@ -191,6 +475,7 @@ async def check_notifications_task():
     """Periodically checks the database for pending notifications and processes them."""
     # logger.debug("Checking for pending notifications...") # Too noisy for INFO level
     notifications = db.get_pending_notifications()
+    NOTIFICATION_BACKLOG.set(len(notifications))
     if not notifications:
         # logger.debug("No pending notifications found.")
         return
@@ -203,11 +488,28 @@ async def check_notifications_task():
         user_id = notification["user_id"]
         original_filename = notification["original_filename"]
 
+        queued_at = db.parse_timestamp(notification["created_at"])
+        # The webapp queues the preview and the notification together, so the
+        # preview is often still being made; wait a little for it to show up
+        preview = await asyncio.to_thread(db.get_preview, file_id)
+        if (preview is None or preview["status"] == "pending") and (
+            datetime.now(timezone.utc) - queued_at
+        ).total_seconds() < PREVIEW_NOTIFY_WAIT_SECONDS:
+            logger.debug(f"Holding notification {notif_id} until its preview is ready")
+            continue
+
         logger.info(f"Processing notification {notif_id} for file {file_id}...")
         try:
-            await send_completion_message(
-                channel_id, user_id, file_id, original_filename
+            sent = await send_completion_message(
+                channel_id, user_id, file_id, original_filename, preview
             )
+            if sent:
+                NOTIFICATIONS_TOTAL.labels("sent").inc()
+                NOTIFICATION_LATENCY.observe(
+                    (datetime.now(timezone.utc) - queued_at).total_seconds()
+                )
+            else:
+                NOTIFICATIONS_TOTAL.labels("failed").inc()
             # If sending succeeded, delete the notification
             if db.delete_notification(notif_id):
                 logger.info(
@@ -218,6 +520,7 @@ async def check_notifications_task():
                     f"Failed to delete notification {notif_id} after processing."
                 )
         except Exception as e:
+            NOTIFICATIONS_TOTAL.labels("error").inc()
             logger.error(
                 f"Error processing notification {notif_id} for file {file_id}: {e}",
                 exc_info=True,
@@ -241,5 +544,6 @@ async def before_check_notifications():
 # --- Main Execution ---
 if __name__ == "__main__":
     logger.info("Starting Discord Bot...")
-    # The task is started in on_ready after command sync
+    metrics.start_metrics_server(BOT_METRICS_PORT)
+    # Commands are synced (if changed) and the task is started in setup_hook
     bot.run(BOT_TOKEN)
@@ -2,14 +2,20 @@ import os
 import sys
 import time
 import logging
-from webdav3.client import Client
+from datetime import datetime, timezone
 from dotenv import load_dotenv
+from prometheus_client import Counter, Gauge, Histogram
 import schedule  # Using schedule library for simplicity, can be replaced by cron in Docker
 
 # Add the parent directory to sys.path to allow importing webapp.database
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 try:
     import webapp.database as db
+    import webapp.metrics as metrics
+    import webapp.tracing as tracing
+    import webapp.previews as previews
+    import webapp.retention as retention
+    import webapp.storage as storage
 except ImportError:
     print("Error: Could not import database module. Make sure it's accessible.")
     sys.exit(1)
@@ -17,13 +23,11 @@ except ImportError:
 # --- Configuration ---
 load_dotenv(dotenv_path="../.env")
 
-# NAS WebDAV Config
-NAS_WEBDAV_URL = os.getenv("NAS_WEBDAV_URL")
-NAS_WEBDAV_USER = os.getenv("NAS_WEBDAV_USER")
-NAS_WEBDAV_PASS = os.getenv("NAS_WEBDAV_PASS")
-NAS_TARGET_FOLDER = os.getenv("NAS_TARGET_FOLDER", "/DiscordUploads").strip(
-    "/"
-)  # Ensure no leading/trailing slashes initially
+# NAS Config (backend and credentials are read by webapp.storage)
+NAS_TARGET_FOLDER = storage.NAS_TARGET_FOLDER
+# Move files out of the cache instead of copying them (an os.rename when the
+# cache and a locally mounted NAS share a filesystem)
+NAS_MOVE_FROM_CACHE = os.getenv("NAS_MOVE_FROM_CACHE", "false").lower() == "true"
 
 # App Config
 CACHE_DIR = os.path.abspath(os.getenv("CACHE_DIR", "../data/pending_uploads"))
@@ -31,6 +35,10 @@ UPLOADER_INTERVAL_SECONDS = int(os.getenv("UPLOADER_INTERVAL_SECONDS", 600))
 CACHE_CLEANUP_AGE_DAYS = int(
     os.getenv("CACHE_CLEANUP_AGE_DAYS", 7)
 )  # 0 or negative means no cleanup
+# Unreferenced cache files younger than this may belong to an upload in progress
+ORPHAN_GRACE_SECONDS = int(os.getenv("ORPHAN_GRACE_SECONDS", 3600))
+RETENTION_INTERVAL_SECONDS = int(os.getenv("RETENTION_INTERVAL_SECONDS", 3600))
+UPLOADER_METRICS_PORT = int(os.getenv("UPLOADER_METRICS_PORT", 9101))  # 0 disables
 
 # Basic Logging
 logging.basicConfig(
@@ -38,45 +46,54 @@ logging.basicConfig(
 )
 logger = logging.getLogger("nas_uploader")
 
+# --- Metrics ---
+UPLOAD_STATUSES = ("cached", "uploading_to_nas", "on_nas", "error")
+QUEUE_DEPTH = Gauge("uploader_queue_depth", "Upload records per status.", ["status"])
+TRANSFER_LATENCY = Histogram(
+    "uploader_transfer_duration_seconds",
+    "Time taken to copy one file from the cache to the NAS.",
+    buckets=metrics.LATENCY_BUCKETS,
+)
+TRANSFER_THROUGHPUT = Histogram(
+    "uploader_transfer_throughput_bytes_per_second",
+    "Per-file throughput from the cache to the NAS.",
+    buckets=metrics.THROUGHPUT_BUCKETS,
+)
+TRANSFER_BYTES = Counter(
+    "uploader_transfer_bytes_total", "Bytes transferred to the NAS."
+)
+TRANSFERS_TOTAL = Counter(
+    "uploader_transfers_total", "NAS transfer attempts.", ["outcome"]
+)
+TIME_TO_NAS = Histogram(
+    "uploader_time_to_nas_seconds",
+    "Time from the original upload until the file is stored on the NAS.",
+    buckets=metrics.DELAY_BUCKETS,
+)
 
-# --- WebDAV Client Setup ---
-def get_webdav_client():
-    """Creates and returns a configured WebDAV client."""
-    if not all([NAS_WEBDAV_URL, NAS_WEBDAV_USER, NAS_WEBDAV_PASS]):
-        logger.error("WebDAV credentials not fully configured in .env file.")
-        return None
-    options = {
-        "webdav_hostname": NAS_WEBDAV_URL,
-        "webdav_login": NAS_WEBDAV_USER,
-        "webdav_password": NAS_WEBDAV_PASS,
-        # Add other options if needed, e.g., cert verification path
-        # 'webdav_cert_path': '/path/to/cert'
-    }
-    try:
-        client = Client(options)
-        # Check connection / create base directory if needed
-        if not client.is_dir(NAS_TARGET_FOLDER):
-            logger.info(
-                f"Base NAS target folder '{NAS_TARGET_FOLDER}' not found, attempting to create."
-            )
-            try:
-                client.mkdir(NAS_TARGET_FOLDER)
-                logger.info(f"Created base NAS folder: {NAS_TARGET_FOLDER}")
-            except Exception as mkdir_err:
-                logger.error(
-                    f"Failed to create base NAS folder '{NAS_TARGET_FOLDER}': {mkdir_err}"
-                )
-                return None  # Cannot proceed if base folder cannot be created
-        return client
-    except Exception as e:
-        logger.error(f"Failed to initialize WebDAV client: {e}", exc_info=True)
+
+def update_queue_depth():
+    """Refreshes the per-status queue depth gauges from the database."""
+    counts = db.count_uploads_by_status()
+    for status in set(UPLOAD_STATUSES) | set(counts):
+        QUEUE_DEPTH.labels(status).set(counts.get(status, 0))
+
+
+# --- Storage Backend Setup ---
+def get_storage_backend(pool_size=1):
+    """Creates the configured NAS storage backend and makes sure the target folder exists."""
+    backend = storage.get_backend(pool_size=pool_size)
+    if backend is None or not backend.prepare():
         return None
+    return backend
 
 
 # --- Core Upload Logic ---
+@tracing.traced("upload_pending_files", profile=True)
 def upload_pending_files():
     """Checks DB for 'cached' files and uploads them to NAS."""
     logger.info("Starting pending file upload check...")
+    update_queue_depth()
     pending_files = db.get_uploads_by_status("cached")
 
     if not pending_files:
@@ -84,9 +101,9 @@ def upload_pending_files():
         return
 
     logger.info(f"Found {len(pending_files)} file(s) pending upload.")
-    client = get_webdav_client()
-    if not client:
-        logger.error("Cannot proceed with uploads: WebDAV client not available.")
+    backend = get_storage_backend()
+    if not backend:
+        logger.error("Cannot proceed with uploads: storage backend not available.")
         return
 
     for file_record in pending_files:
@@ -97,34 +114,84 @@ def upload_pending_files():
         # Example: /DiscordUploads/2025/04/file_id_original.ext
         # For simplicity now, just use file_id + original name
         remote_filename = f"{file_id}_{original_filename}"
-        remote_path = (
-            f"{NAS_TARGET_FOLDER}/{remote_filename}"  # webdavclient3 handles joining
-        )
+        remote_path = f"{NAS_TARGET_FOLDER}/{remote_filename}"
 
         logger.info(
             f"Attempting to upload {file_id} ({original_filename}) from {cached_path} to {remote_path}"
         )
 
         if not os.path.exists(cached_path):
+            # With NAS_MOVE_FROM_CACHE the cached file is gone once it is stored;
+            # a crash (or failed update) before 'on_nas' was recorded leaves the
+            # row 'cached', so look for the stored copy before giving up on it
+            stored_path = file_record["nas_path"] or remote_path
+            try:
+                stored = backend.exists(stored_path)
+            except Exception as e:
+                logger.error(
+                    f"Cached file for {file_id} is missing and NAS copy {stored_path} "
+                    f"could not be checked: {e}. Will retry."
+                )
+                continue
+            if stored and db.update_upload_status(
+                file_id, "on_nas", nas_path=stored_path, drop_cached_path=True
+            ):
+                logger.warning(
+                    f"Cached file for {file_id} is missing but it is on the NAS at "
+                    f"{stored_path}. Set status to 'on_nas'."
+                )
+                TRANSFERS_TOTAL.labels("recovered").inc()
+                continue
             logger.error(
                 f"Cached file not found for {file_id}: {cached_path}. Setting status to 'error'."
             )
             db.update_upload_status(file_id, "error")
+            TRANSFERS_TOTAL.labels("missing").inc()
             continue
 
         try:
-            # Update status to 'uploading' before starting
-            db.update_upload_status(file_id, "uploading_to_nas")
+            # Update status to 'uploading' before starting. Record where the file
+            # is going too, so it can be found if the cached copy is moved away
+            # and the 'on_nas' update below never happens.
+            db.update_upload_status(file_id, "uploading_to_nas", nas_path=remote_path)
             logger.debug(f"Set status to 'uploading_to_nas' for {file_id}")
 
             # Perform the upload
-            client.upload_sync(remote_path=remote_path, local_path=cached_path)
+            transfer_start = time.perf_counter()
+            with tracing.span(
+                "storage.store",
+                backend=backend.name,
+                file_id=file_id,
+                file_size=file_record["file_size"],
+            ):
+                backend.store(cached_path, remote_path, move=NAS_MOVE_FROM_CACHE)
+            transfer_seconds = time.perf_counter() - transfer_start
             logger.info(f"Successfully uploaded {file_id} to {remote_path}")
 
             # Update status to 'on_nas' and store nas_path
-            db.update_upload_status(file_id, "on_nas", nas_path=remote_path)
+            if not db.update_upload_status(
+                file_id,
+                "on_nas",
+                nas_path=remote_path,
+                drop_cached_path=NAS_MOVE_FROM_CACHE,
+            ):
+                # Reverted to 'cached' below; the next pass finds the stored copy
+                raise RuntimeError(f"Could not record {file_id} as stored on the NAS")
             logger.info(f"Updated status to 'on_nas' for {file_id}")
 
+            TRANSFERS_TOTAL.labels("success").inc()
+            metrics.observe_transfer(
+                TRANSFER_LATENCY,
+                TRANSFER_THROUGHPUT,
+                TRANSFER_BYTES,
+                file_record["file_size"],
+                transfer_seconds,
+            )
+            uploaded_at = db.parse_timestamp(file_record["upload_timestamp"])
+            TIME_TO_NAS.observe(
+                (datetime.now(timezone.utc) - uploaded_at).total_seconds()
+            )
+
             # Optional: Cleanup cache immediately or based on policy
             # if CACHE_CLEANUP_AGE_DAYS == 0: # Immediate cleanup
             #     try:
@@ -135,6 +202,7 @@ def upload_pending_files():
 
         except Exception as e:
             logger.error(f"Failed to upload {file_id} to NAS: {e}", exc_info=True)
+            TRANSFERS_TOTAL.labels("error").inc()
             # Revert status to 'cached' for retry later? Or set to 'error'?
             # Let's revert to 'cached' for now to allow retries.
             db.update_upload_status(file_id, "cached")
@@ -142,9 +210,73 @@ def upload_pending_files():
                 f"Reverted status to 'cached' for {file_id} after upload failure."
             )
 
+    update_queue_depth()
     logger.info("Finished pending file upload check.")
 
 
+# --- Startup Reconciliation ---
+def reconcile_cache():
+    """Repairs state left behind by a crash. Run once at startup, before uploading.
+
+    Rows stuck in 'uploading_to_nas' go back to 'cached' so they are retried, and
+    files in CACHE_DIR that no upload record references (saved but never
+    committed) are removed once they are older than ORPHAN_GRACE_SECONDS.
+    """
+    logger.info("Reconciling cache directory with the database...")
+    reset_count = db.reset_interrupted_uploads()
+    if reset_count:
+        logger.warning(
+            f"Reset {reset_count} interrupted upload(s) from 'uploading_to_nas' to 'cached'."
+        )
+
+    known_paths = db.get_cached_paths()
+    if known_paths is None:
+        logger.error("Skipping orphan cleanup: could not load cached paths.")
+        return
+    # Cached filenames start with the file_id, so basenames are unique
+    known_names = {os.path.basename(path) for path in known_paths}
+    cutoff = time.time() - ORPHAN_GRACE_SECONDS
+    removed = kept = 0
+    try:
+        with os.scandir(CACHE_DIR) as entries:
+            for entry in entries:
+                if entry.name in known_names or not entry.is_file(
+                    follow_symlinks=False
+                ):
+                    continue
+                if entry.stat(follow_symlinks=False).st_mtime > cutoff:
+                    kept += 1
+                    continue
+                try:
+                    os.remove(entry.path)
+                    removed += 1
+                except OSError as e:
+                    logger.error(
+                        f"Error removing orphaned cache file {entry.path}: {e}"
+                    )
+    except FileNotFoundError:
+        logger.warning(f"Cache directory {CACHE_DIR} does not exist yet.")
+        return
+    logger.info(
+        f"Cache reconciliation done: removed {removed} orphaned file(s), "
+        f"kept {kept} recent unreferenced file(s)."
+    )
+
+
+# --- Retention ---
+@tracing.traced("apply_retention", profile=True)
+def apply_retention():
+    """Expires uploads past their retention policy and deletes their stored files."""
+    expired = retention.expire_old_uploads()
+    if expired:
+        logger.info(f"Retention policy expired {expired} upload(s).")
+    backend = None
+    if db.get_unpurged_expired(1):
+        backend = get_storage_backend(pool_size=retention.RETENTION_DELETE_WORKERS)
+    retention.purge_expired(backend)
+    update_queue_depth()
+
+
 # --- TODO: Cache Cleanup Logic ---
 def cleanup_old_cache_files():
     """Removes files from cache that are 'on_nas' and older than policy."""
@@ -169,12 +301,18 @@ def cleanup_old_cache_files():
 def run_scheduled_tasks():
     """Runs the main tasks according to the schedule."""
     schedule.every(UPLOADER_INTERVAL_SECONDS).seconds.do(upload_pending_files)
+    # Catch up on previews the webapp did not get to (e.g. it restarted)
+    schedule.every(UPLOADER_INTERVAL_SECONDS).seconds.do(
+        previews.generate_pending_previews
+    )
+    schedule.every(RETENTION_INTERVAL_SECONDS).seconds.do(apply_retention)
     # schedule.every().day.at("03:00").do(cleanup_old_cache_files) # Example: Run cleanup daily at 3 AM
 
     logger.info(
         f"Scheduler started. Upload check interval: {UPLOADER_INTERVAL_SECONDS} seconds."
     )
-    upload_pending_files()  # Run once immediately on start
+    previews.generate_pending_previews()  # Run once immediately on start
+    upload_pending_files()
 
     while True:
         schedule.run_pending()
@@ -184,6 +322,9 @@ def run_scheduled_tasks():
 # --- Main Execution ---
 if __name__ == "__main__":
     logger.info("Starting NAS Uploader Service...")
-    # Perform initial DB check/init (already done on import, but good practice)
+    # Create or upgrade the schema up front rather than on first use
     db.init_db()
+    reconcile_cache()
+    metrics.start_metrics_server(UPLOADER_METRICS_PORT)
+    tracing.install_profile_signal_handler()
     run_scheduled_tasks()
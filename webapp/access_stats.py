@@ -0,0 +1,101 @@
+import os
+import time
+import atexit
+import logging
+import threading
+from datetime import datetime, timezone
+from prometheus_client import Counter
+import webapp.database as db
+
+# Download access statistics for the webapp.
+# Writing to SQLite on every /download would make hot links fight over the
+# database write lock, so downloads are counted in memory per process and
+# added to the download_stats table in one batched transaction every
+# ACCESS_STATS_FLUSH_SECONDS (and on exit). Upserts add to the stored totals,
+# so any number of workers can flush independently.
+
+ACCESS_STATS_FLUSH_SECONDS = float(os.getenv("ACCESS_STATS_FLUSH_SECONDS", 10))
+
+logger = logging.getLogger("access_stats")
+
+FLUSHES_TOTAL = Counter(
+    "webapp_access_stats_flushes_total",
+    "Batched writes of buffered download counters.",
+    ["outcome"],
+)
+
+_lock = threading.Lock()
+_pending = {}  # file_id -> [download_count, bytes_served, last_access]
+_flusher = None
+_flusher_pid = None
+
+
+def record_download(file_id, num_bytes):
+    """Counts one finished download of file_id in the in-memory buffer."""
+    now = datetime.now(timezone.utc)
+    with _lock:
+        entry = _pending.get(file_id)
+        if entry is None:
+            _pending[file_id] = [1, num_bytes or 0, now]
+        else:
+            entry[0] += 1
+            entry[1] += num_bytes or 0
+            entry[2] = now
+    _ensure_flusher()
+
+
+def flush():
+    """Writes the buffered counters to the database. Returns the number of files written."""
+    global _pending
+    with _lock:
+        if not _pending:
+            return 0
+        batch, _pending = _pending, {}
+    entries = [
+        (file_id, count, num_bytes, last_access)
+        for file_id, (count, num_bytes, last_access) in batch.items()
+    ]
+    if db.add_download_stats(entries):
+        FLUSHES_TOTAL.labels("success").inc()
+        return len(entries)
+
+    # Keep the counts for the next attempt rather than losing them
+    FLUSHES_TOTAL.labels("error").inc()
+    with _lock:
+        for file_id, (count, num_bytes, last_access) in batch.items():
+            entry = _pending.get(file_id)
+            if entry is None:
+                _pending[file_id] = [count, num_bytes, last_access]
+            else:
+                entry[0] += count
+                entry[1] += num_bytes
+                entry[2] = max(entry[2], last_access)
+    return 0
+
+
+def _flush_loop():
+    while True:
+        time.sleep(ACCESS_STATS_FLUSH_SECONDS)
+        try:
+            flush()
+        except Exception as e:
+            logger.error(f"Failed to flush download stats: {e}", exc_info=True)
+
+
+def _ensure_flusher():
+    # Started on first use (and again after a fork), so each Gunicorn worker
+    # gets its own flusher thread
+    global _flusher, _flusher_pid
+    if _flusher_pid == os.getpid():
+        return
+    with _lock:
+        if _flusher_pid == os.getpid():
+            return
+        _flusher = threading.Thread(
+            target=_flush_loop, name="access-stats-flush", daemon=True
+        )
+        _flusher.start()
+        _flusher_pid = os.getpid()
+
+
+atexit.register(flush)
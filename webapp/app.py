@@ -1,6 +1,10 @@
 import os
+import hmac
+import time
 import uuid
+import shutil
 import logging
+import ipaddress
 from datetime import datetime, timezone  # Removed timedelta
 from flask import (
     Flask,
@@ -9,13 +13,24 @@ from flask import (
     redirect,
     url_for,
     send_from_directory,
+    send_file,
     abort,
     flash,
+    Response,
     # Removed make_response
 )
+from werkzeug.exceptions import HTTPException, RequestEntityTooLarge
 from werkzeug.utils import secure_filename
+from werkzeug.middleware.proxy_fix import ProxyFix
 from dotenv import load_dotenv
+from prometheus_client import Counter, Histogram
 import webapp.database as db  # Import the database module
+import webapp.metrics as metrics
+import webapp.tracing as tracing
+import webapp.previews as previews
+import webapp.storage as storage
+import webapp.access_stats as access_stats
+import webapp.ratelimit as ratelimit
 
 # --- Configuration ---
 load_dotenv(dotenv_path="../.env")  # Load .env from parent directory
@@ -30,17 +45,78 @@ app.config["DATABASE_PATH"] = os.path.abspath(
     os.getenv("DATABASE_PATH", "../data/database/metadata.db")
 )
 app.config["APP_BASE_URL"] = os.getenv("FLASK_APP_BASE_URL", "http://localhost:5000")
+# Reverse proxies in front of the app whose X-Forwarded-For is trusted, so
+# per-IP download limits see the real client address
+app.config["TRUSTED_PROXY_COUNT"] = int(os.getenv("TRUSTED_PROXY_COUNT", 0))
+if app.config["TRUSTED_PROXY_COUNT"] > 0:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config["TRUSTED_PROXY_COUNT"])
+# /metrics shares the public port, so it is only served to these client
+# networks, or to requests carrying METRICS_TOKEN as a bearer token
+app.config["METRICS_ALLOWED_NETWORKS"] = [
+    ipaddress.ip_network(network.strip(), strict=False)
+    for network in os.getenv("METRICS_ALLOWED_NETWORKS", "127.0.0.1,::1").split(",")
+    if network.strip()
+]
+app.config["METRICS_TOKEN"] = os.getenv("METRICS_TOKEN")
 # UPLOAD_TOKEN_EXPIRY_SECONDS is now primarily used in database.py
+# --- Upload Admission Control (0 disables a limit) ---
+# Hard cap on a single request body, enforced by Flask while streaming
+app.config["MAX_CONTENT_LENGTH"] = int(os.getenv("MAX_UPLOAD_BYTES", 0)) or None
+# Total bytes a single Discord user / channel may keep stored
+app.config["USER_QUOTA_BYTES"] = int(os.getenv("USER_QUOTA_BYTES", 0))
+app.config["CHANNEL_QUOTA_BYTES"] = int(os.getenv("CHANNEL_QUOTA_BYTES", 0))
+# Free space that must remain on the cache volume after an upload
+app.config["CACHE_MIN_FREE_BYTES"] = int(os.getenv("CACHE_MIN_FREE_BYTES", 0))
+# Allowance for multipart boundaries and headers around the file itself
+MULTIPART_OVERHEAD_BYTES = 64 * 1024
+# Browser / proxy cache lifetime for /preview responses
+PREVIEW_MAX_AGE_SECONDS = 86400
+# Keep-alive connections to the NAS for downloads served from it (WebDAV backend)
+NAS_DOWNLOAD_CONNECTIONS = 4
+_storage_backend = None
 
 # Ensure upload folder exists
 os.makedirs(app.config["UPLOAD_FOLDER"], exist_ok=True)
-# Database is initialized in database.py when imported
+# The schema is created or upgraded on the first database connection
 
 # Configure logging
 logging.basicConfig(
     level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
 )
 app.logger.setLevel(logging.INFO)
+tracing.install_profile_signal_handler()
+
+# --- Metrics ---
+UPLOAD_LATENCY = Histogram(
+    "webapp_upload_duration_seconds",
+    "Time from receiving an upload POST to the file being committed to the cache.",
+    buckets=metrics.LATENCY_BUCKETS,
+)
+UPLOAD_THROUGHPUT = Histogram(
+    "webapp_upload_throughput_bytes_per_second",
+    "Per-upload throughput into the cache.",
+    buckets=metrics.THROUGHPUT_BUCKETS,
+)
+UPLOAD_BYTES = Counter("webapp_upload_bytes_total", "Bytes accepted by uploads.")
+UPLOADS_TOTAL = Counter("webapp_uploads_total", "Upload attempts.", ["outcome"])
+DOWNLOAD_LATENCY = Histogram(
+    "webapp_download_duration_seconds",
+    "Time from a download request until the response body is fully sent.",
+    ["source"],
+    buckets=metrics.LATENCY_BUCKETS,
+)
+DOWNLOAD_THROUGHPUT = Histogram(
+    "webapp_download_throughput_bytes_per_second",
+    "Per-download throughput.",
+    ["source"],
+    buckets=metrics.THROUGHPUT_BUCKETS,
+)
+DOWNLOAD_BYTES = Counter(
+    "webapp_download_bytes_total", "Bytes served by downloads.", ["source"]
+)
+DOWNLOADS_TOTAL = Counter(
+    "webapp_downloads_total", "Download requests.", ["source", "outcome"]
+)
 
 # --- Helper Functions ---
 # Removed old is_token_valid and invalidate_token - using db module now
@@ -51,13 +127,184 @@ def generate_file_id():
     return str(uuid.uuid4())
 
 
+def _remove_cached_file(cached_path):
+    """Removes a (partially) saved cache file that has no committed upload record."""
+    if os.path.exists(cached_path):
+        try:
+            os.remove(cached_path)
+            app.logger.info(f"Cleaned up partially saved file: {cached_path}")
+        except OSError as rm_err:
+            app.logger.error(f"Error cleaning up file {cached_path}: {rm_err}")
+
+
+def upload_allowance(context):
+    """Returns how many bytes this upload may store, or None if unlimited.
+
+    The smallest of the per-request cap, the remaining user and channel quota
+    and the free space above the cache reserve wins.
+    """
+    limits = []
+    if app.config["MAX_CONTENT_LENGTH"]:
+        limits.append(app.config["MAX_CONTENT_LENGTH"])
+    if app.config["USER_QUOTA_BYTES"] or app.config["CHANNEL_QUOTA_BYTES"]:
+        usage = db.get_quota_usage(context)
+        if usage is None:
+            abort(503, description="Upload quota could not be checked.")
+        if app.config["USER_QUOTA_BYTES"]:
+            limits.append(app.config["USER_QUOTA_BYTES"] - usage["user"])
+        if app.config["CHANNEL_QUOTA_BYTES"]:
+            limits.append(app.config["CHANNEL_QUOTA_BYTES"] - usage["channel"])
+    if app.config["CACHE_MIN_FREE_BYTES"]:
+        free = shutil.disk_usage(app.config["UPLOAD_FOLDER"]).free
+        limits.append(free - app.config["CACHE_MIN_FREE_BYTES"])
+    return max(0, min(limits)) if limits else None
+
+
+def upload_body_limit(token):
+    """Returns the largest request body an upload with this token may send.
+
+    None means unlimited. An invalid token, or a quota that cannot be checked,
+    allows no body at all; the view then reports the error without it.
+    """
+    context = db.get_token_context(token)
+    if not context:
+        return 0
+    with app.app_context():
+        try:
+            allowance = upload_allowance(context)
+        except HTTPException:
+            return 0
+    return None if allowance is None else allowance + MULTIPART_OVERHEAD_BYTES
+
+
+def _reject_upload(allowance):
+    UPLOADS_TOTAL.labels("rejected").inc()
+    abort(
+        413,
+        description=f"Upload exceeds the space available to you ({allowance} bytes).",
+    )
+
+
+def get_storage_backend():
+    """Returns the NAS storage backend used for downloads, created on first use."""
+    global _storage_backend
+    if _storage_backend is None:
+        _storage_backend = storage.get_backend(pool_size=NAS_DOWNLOAD_CONNECTIONS)
+    return _storage_backend
+
+
+def _shape_download(response, file_id):
+    """Applies the download bandwidth limits to a file response.
+
+    Returns None (after closing the response) if the client already has
+    DOWNLOAD_MAX_STREAMS_PER_IP downloads open.
+    """
+    if not ratelimit.ENABLED:
+        return response
+    stream = ratelimit.open_stream(file_id, request.remote_addr)
+    if stream is None:
+        response.close()
+        return None
+    # Iterating the body in Python (instead of sendfile) is what lets it be paced
+    response.response = ratelimit.ShapedBody(response.response, stream)
+    return response
+
+
+def _too_many_downloads(source):
+    DOWNLOADS_TOTAL.labels(source, "rejected").inc()
+    return Response(
+        "Too many downloads in progress from your address. Try again later.",
+        status=429,
+        headers={"Retry-After": "30"},
+        mimetype="text/plain",
+    )
+
+
+def _call_on_close(response, callback):
+    """Runs callback once the response body has been sent.
+
+    File responses are handed to the WSGI server as a passthrough file wrapper
+    (so it can use sendfile), which bypasses response.call_on_close; hook the
+    wrapper's own close() in that case instead.
+    """
+    body = response.response
+    if response.direct_passthrough and hasattr(body, "close"):
+        close_body = body.close
+
+        def close():
+            try:
+                close_body()
+            finally:
+                callback()
+
+        body.close = close
+    else:
+        response.call_on_close(callback)
+
+
+def _trace_until_close(response, file_id, source):
+    """Keeps the request's root span open until the body has been sent, and
+    reports the streaming itself as a child span."""
+    root = tracing.detach(keep_profiler=not request.environ.get("webapp.asgi_bridge"))
+    body_start = time.perf_counter()
+
+    def finish():
+        tracing.record(
+            "download.body",
+            (time.perf_counter() - body_start) * 1000,
+            root,
+            file_id=file_id,
+            source=source,
+        )
+        tracing.finish(root)
+
+    _call_on_close(response, finish)
+
+
+def _metrics_allowed():
+    """Whether this request may read /metrics (see METRICS_ALLOWED_NETWORKS)."""
+    token = app.config["METRICS_TOKEN"]
+    if token and hmac.compare_digest(
+        request.headers.get("Authorization", ""), f"Bearer {token}"
+    ):
+        return True
+    try:
+        client = ipaddress.ip_address(request.remote_addr)
+    except ValueError:
+        return False
+    client = getattr(client, "ipv4_mapped", None) or client
+    return any(client in network for network in app.config["METRICS_ALLOWED_NETWORKS"])
+
+
+def _observe_download(file_id, source, num_bytes, start):
+    """Records a finished download once its response has been closed."""
+    access_stats.record_download(file_id, num_bytes)
+    DOWNLOADS_TOTAL.labels(source, "success").inc()
+    metrics.observe_transfer(
+        DOWNLOAD_LATENCY.labels(source),
+        DOWNLOAD_THROUGHPUT.labels(source),
+        DOWNLOAD_BYTES.labels(source),
+        num_bytes,
+        time.perf_counter() - start,
+    )
+
+
 # --- Routes ---
 @app.route("/")
 def index():
     return "Web App is Running!"  # Simple index page
 
 
+@app.route("/metrics")
+def metrics_endpoint():
+    if not _metrics_allowed():
+        abort(404)
+    payload, content_type = metrics.render_latest()
+    return Response(payload, content_type=content_type)
+
+
 @app.route("/upload/<string:token>", methods=["GET", "POST"])
+@tracing.traced("upload_file", profile=True)
 def upload_file(token):
     context = db.get_token_context(token)
     if not context:
@@ -66,7 +313,24 @@ def upload_file(token):
 
     if request.method == "POST":
         # --- Handle File Upload ---
-        if "file" not in request.files:
+        upload_start = time.perf_counter()
+        allowance = upload_allowance(context)
+        if allowance is not None:
+            # Reject before reading the body when the declared size is too big,
+            # otherwise let Werkzeug abort the stream once it passes the limit
+            stream_limit = allowance + MULTIPART_OVERHEAD_BYTES
+            if request.content_length and request.content_length > stream_limit:
+                app.logger.warning(
+                    f"Rejected upload of {request.content_length} bytes for token {token} (allowance {allowance})"
+                )
+                _reject_upload(allowance)
+            request.max_content_length = stream_limit
+        try:
+            has_file = "file" in request.files
+        except RequestEntityTooLarge:
+            app.logger.warning(f"Aborted upload over its allowance for token {token}")
+            _reject_upload(allowance)
+        if not has_file:
             flash("No file part")
             return redirect(request.url)
         file = request.files["file"]
@@ -87,40 +351,49 @@ def upload_file(token):
                 file_size = file.tell()
                 file.seek(0)  # Reset cursor position
                 content_type = file.content_type
+                if allowance is not None and file_size > allowance:
+                    _reject_upload(allowance)
 
-                file.save(cached_path)
+                with tracing.span("upload.save", file_size=file_size):
+                    file.save(cached_path)
                 app.logger.info(f"File saved to cache: {cached_path}")
 
-                # Store metadata in the database
-                if db.add_upload_record(
-                    file_id,
-                    original_filename,
-                    cached_path,
-                    context,
-                    content_type,
-                    file_size,
-                ):
-                    app.logger.info(f"Upload record added for file_id: {file_id}")
-                else:
-                    app.logger.error(
-                        f"Failed to add upload record for file_id: {file_id}"
+                # Record the upload, queue the bot notification and consume
+                # the token in one transaction; the quotas are checked again
+                # there in case parallel uploads used them up meanwhile
+                try:
+                    committed = db.commit_upload(
+                        token,
+                        file_id,
+                        original_filename,
+                        cached_path,
+                        context,
+                        content_type,
+                        file_size,
+                        user_quota=app.config["USER_QUOTA_BYTES"],
+                        channel_quota=app.config["CHANNEL_QUOTA_BYTES"],
                     )
-                    # Consider cleanup and error message
-                    flash("Database error occurred.")
-                    # Maybe remove the saved file? os.remove(cached_path)
-                    return redirect(request.url)
-
-                # Add notification for the bot to process
-                if db.add_bot_notification(file_id, context, original_filename):
+                except db.QuotaExceeded:
+                    app.logger.warning(
+                        f"Rejected upload {file_id} for token {token}: quota used up by concurrent uploads"
+                    )
+                    _remove_cached_file(cached_path)
+                    _reject_upload(allowance)
+                if committed:
                     app.logger.info(
-                        f"Added notification for bot for file_id: {file_id}"
+                        f"Upload committed for file_id: {file_id} (token {token} invalidated)"
                     )
                 else:
-                    # Log an error, but maybe don't fail the whole upload?
-                    # The bot might pick it up later if it polls the main uploads table.
-                    app.logger.error(
-                        f"Failed to add bot notification for file_id: {file_id}"
+                    app.logger.error(f"Failed to commit upload for file_id: {file_id}")
+                    UPLOADS_TOTAL.labels("error").inc()
+                    _remove_cached_file(cached_path)
+                    flash(
+                        "The upload could not be recorded. The link may already have been used."
                     )
+                    return redirect(request.url)
+
+                # Build the thumbnail / text preview in the background
+                previews.submit(file_id, cached_path, original_filename, content_type)
 
                 share_link = url_for(
                     "download_file", file_id=file_id, _external=True
@@ -128,30 +401,29 @@ def upload_file(token):
                 app.logger.info(
                     f"Generated share link: {share_link}"
                 )  # Log for debugging
-                # Invalidate the token after successful upload
-                db.delete_token(token)
-                app.logger.info(f"Upload token invalidated: {token}")
+
+                UPLOADS_TOTAL.labels("success").inc()
+                metrics.observe_transfer(
+                    UPLOAD_LATENCY,
+                    UPLOAD_THROUGHPUT,
+                    UPLOAD_BYTES,
+                    file_size,
+                    time.perf_counter() - upload_start,
+                )
 
                 # TODO: Return a proper success page template render_template('success.html', share_link=share_link)
                 return f"Upload Successful! File ID: {file_id}. Share link will be sent to Discord shortly."
 
+            except HTTPException:
+                raise
             except Exception as e:
+                UPLOADS_TOTAL.labels("error").inc()
                 app.logger.error(
                     f"Error saving file {original_filename} for token {token}: {e}",
                     exc_info=True,
                 )
                 flash(f"An error occurred during upload: {e}")
-                # Consider cleaning up partially saved file if necessary
-                if os.path.exists(cached_path):
-                    try:
-                        os.remove(cached_path)
-                        app.logger.info(
-                            f"Cleaned up partially saved file: {cached_path}"
-                        )
-                    except OSError as rm_err:
-                        app.logger.error(
-                            f"Error cleaning up file {cached_path}: {rm_err}"
-                        )
+                _remove_cached_file(cached_path)
                 return redirect(request.url)
 
     # --- Serve Upload Form (GET Request) ---
@@ -159,13 +431,39 @@ def upload_file(token):
     return render_template("upload.html", token=token)
 
 
+@app.route("/preview/<string:file_id>")
+def preview_file(file_id):
+    """Serves the small derivative (thumbnail, poster frame or text snippet) of an upload."""
+    preview = db.get_preview(file_id)
+    if not preview or preview["status"] != "ready":
+        abort(404, description="No preview available.")
+    # Previews never change once built, so let clients and proxies cache them
+    if preview["kind"] == "text":
+        response = Response(preview["text"], content_type=preview["content_type"])
+        response.cache_control.public = True
+        response.cache_control.max_age = PREVIEW_MAX_AGE_SECONDS
+        return response
+    return send_from_directory(
+        previews.PREVIEW_DIR,
+        os.path.basename(preview["path"]),
+        mimetype=preview["content_type"],
+        max_age=PREVIEW_MAX_AGE_SECONDS,
+    )
+
+
 @app.route("/download/<string:file_id>")
+@tracing.traced("download_file", profile=True)
 def download_file(file_id):
     app.logger.info(f"Download request received for file_id: {file_id}")
+    download_start = time.perf_counter()
     record = db.get_upload_record(file_id)
 
     if not record:
+        if db.get_expired_at(file_id):
+            DOWNLOADS_TOTAL.labels("none", "expired").inc()
+            abort(410, description="This download link has expired.")
         app.logger.warning(f"Download request for non-existent file_id: {file_id}")
+        DOWNLOADS_TOTAL.labels("none", "not_found").inc()
         abort(404, description="File not found.")
 
     # Convert Row to dict for easier access
@@ -180,42 +478,85 @@ def download_file(file_id):
     ):
         app.logger.info(f"Serving file {file_id} from cache: {metadata['cached_path']}")
         try:
-            return send_from_directory(
-                directory=os.path.dirname(metadata["cached_path"]),
-                path=os.path.basename(metadata["cached_path"]),
-                as_attachment=True,
-                download_name=metadata.get(
-                    "original_filename", file_id
-                ),  # Use original filename
-            )
+            with tracing.span("download.send_file", file_id=file_id):
+                response = send_from_directory(
+                    directory=os.path.dirname(metadata["cached_path"]),
+                    path=os.path.basename(metadata["cached_path"]),
+                    as_attachment=True,
+                    download_name=metadata.get(
+                        "original_filename", file_id
+                    ),  # Use original filename
+                )
         except Exception as e:
+            DOWNLOADS_TOTAL.labels("cache", "error").inc()
             app.logger.error(
                 f"Error serving cached file {file_id} from {metadata['cached_path']}: {e}",
                 exc_info=True,
             )
             abort(500, description="Error serving file from cache.")
+        response = _shape_download(response, file_id)
+        if response is None:
+            return _too_many_downloads("cache")
+        # The body is streamed after this view returns, so observe on close
+        _call_on_close(
+            response,
+            lambda: _observe_download(
+                file_id, "cache", response.content_length, download_start
+            ),
+        )
+        _trace_until_close(response, file_id, "cache")
+        return response
 
     # Fallback path: From NAS
     elif metadata.get("status") == "on_nas" and metadata.get("nas_path"):
         nas_path = metadata["nas_path"]
         app.logger.info(
-            f"File {file_id} not in cache. Attempting fallback from NAS path: {nas_path}"
+            f"File {file_id} not in cache. Serving from NAS path: {nas_path}"
+        )
+        backend = get_storage_backend()
+        if backend is None:
+            DOWNLOADS_TOTAL.labels("nas", "error").inc()
+            abort(503, description="File storage is not available.")
+        download_name = metadata.get("original_filename", file_id)
+        try:
+            with tracing.span("download.nas", file_id=file_id, backend=backend.name):
+                local_path = backend.local_path(nas_path)
+                if local_path:
+                    # A mounted share: the WSGI server can sendfile() it directly
+                    response = send_file(
+                        local_path, as_attachment=True, download_name=download_name
+                    )
+                else:
+                    response = send_file(
+                        backend.open(nas_path),
+                        as_attachment=True,
+                        download_name=download_name,
+                        mimetype=metadata.get("content_type") or None,
+                    )
+        except FileNotFoundError:
+            DOWNLOADS_TOTAL.labels("nas", "not_found").inc()
+            app.logger.error(f"File {file_id} is missing from NAS path {nas_path}")
+            abort(404, description="File not found.")
+        except Exception as e:
+            DOWNLOADS_TOTAL.labels("nas", "error").inc()
+            app.logger.error(
+                f"Error streaming file {file_id} from NAS path {nas_path}: {e}",
+                exc_info=True,
+            )
+            abort(500, description="Error retrieving file from storage.")
+        num_bytes = response.content_length or metadata.get("file_size")
+        response = _shape_download(response, file_id)
+        if response is None:
+            return _too_many_downloads("nas")
+        _call_on_close(
+            response,
+            lambda: _observe_download(file_id, "nas", num_bytes, download_start),
         )
-        # TODO: Implement NAS connection (WebDAV/API) and streaming
-        # Example (pseudo-code):
-        # try:
-        #     nas_client = connect_to_nas() # Get configured NAS client
-        #     file_stream = nas_client.download_stream(nas_path)
-        #     response = make_response(file_stream)
-        #     response.headers.set('Content-Type', metadata.get('content_type', 'application/octet-stream'))
-        #     response.headers.set('Content-Disposition', 'attachment', filename=metadata.get('original_filename', file_id))
-        #     return response
-        # except Exception as e:
-        #     app.logger.error(f"Error streaming file {file_id} from NAS path {nas_path}: {e}", exc_info=True)
-        #     abort(500, description="Error retrieving file from storage.")
-        return f"File {file_id} is on NAS at {nas_path} (NAS fallback streaming not implemented yet)."
+        _trace_until_close(response, file_id, "nas")
+        return response
 
     # If neither cached nor on NAS (or status is unexpected)
+    DOWNLOADS_TOTAL.labels("none", "unavailable").inc()
     app.logger.warning(
         f"File {file_id} is in status '{metadata.get('status')}' and cannot be served."
     )
@@ -224,7 +565,7 @@ def download_file(file_id):
 
 # --- Main Execution ---
 if __name__ == "__main__":
-    # Ensure DB is initialized (in case database.py wasn't imported elsewhere first)
+    # Create or upgrade the schema up front rather than on the first request
     db.init_db()
     # Start a background thread or scheduler for cleanup? (Optional here, maybe better in uploader script)
     # db.cleanup_expired_tokens() # Run once on startup
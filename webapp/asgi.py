@@ -0,0 +1,245 @@
+import os
+import re
+import sys
+import asyncio
+import logging
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+import webapp.ratelimit as ratelimit
+from webapp.app import app as flask_app, upload_body_limit
+
+# ASGI serving mode for the webapp:  uvicorn webapp.asgi:app
+#
+# The Flask routes and the database module are used unchanged; what moves to
+# the event loop is everything that waits on the client:
+#   - request bodies (uploads) are received asynchronously into a spooled
+#     temporary file before the view runs, so a slow uploader holds no thread;
+#   - response bodies (cache and NAS downloads) are sent asynchronously, with
+#     each next ASGI_CHUNK_BYTES read in a worker thread, so a slow downloader
+#     holds no thread either; download bandwidth limits sleep on the loop.
+# Worker threads only ever run the view itself and short, local reads.
+
+ASGI_THREADS = int(os.getenv("ASGI_THREADS", 32))
+ASGI_CHUNK_BYTES = int(os.getenv("ASGI_CHUNK_BYTES", 64 * 1024))
+# Request bodies above this size are spooled to disk in the cache directory
+SPOOL_MEMORY_BYTES = 1024 * 1024
+UPLOAD_PATH = re.compile(r"^/upload/([^/]+)$")
+
+logger = logging.getLogger("asgi")
+
+
+def _build_environ(scope, body, content_length):
+    """Translates an ASGI HTTP scope into a WSGI environ (PEP 3333)."""
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf8").decode("latin1"),
+        "PATH_INFO": scope["path"].encode("utf8").decode("latin1"),
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "REMOTE_ADDR": client[0],
+        "REMOTE_PORT": str(client[1]),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": body,
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+        # The response body is read and closed on threads other than the view's
+        "webapp.asgi_bridge": True,
+    }
+    for raw_name, raw_value in scope.get("headers", []):
+        name = raw_name.decode("latin1").upper().replace("-", "_")
+        value = raw_value.decode("latin1")
+        if name == "CONTENT_TYPE":
+            environ["CONTENT_TYPE"] = value
+            continue
+        if name in ("CONTENT_LENGTH", "TRANSFER_ENCODING"):
+            continue  # The body has been fully received; its size is set below
+        key = f"HTTP_{name}"
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    environ["CONTENT_LENGTH"] = str(content_length)
+    return environ
+
+
+def _declared_length(scope):
+    for name, value in scope.get("headers", []):
+        if name == b"content-length":
+            try:
+                return int(value)
+            except ValueError:
+                return None
+    return None
+
+
+async def _receive_body(scope, receive):
+    """Receives the request body into a spooled file.
+
+    Returns (body, length). Reading stops once the body is over its limit (the
+    token's allowance for uploads, nothing for every other route, as no other
+    route reads a body); the view then sees an empty body of that length and
+    rejects or ignores it, as it would under a WSGI server.
+    """
+    limit = 0
+    declared = _declared_length(scope)
+    has_body = declared or any(
+        name == b"transfer-encoding" for name, _ in scope.get("headers", [])
+    )
+    if not has_body:
+        return tempfile.SpooledTemporaryFile(), 0
+    match = UPLOAD_PATH.match(scope["path"])
+    if scope["method"] == "POST" and match:
+        limit = await asyncio.to_thread(upload_body_limit, match.group(1))
+    if limit is not None and declared is not None and declared > limit:
+        return tempfile.SpooledTemporaryFile(), declared
+
+    body = tempfile.SpooledTemporaryFile(
+        max_size=SPOOL_MEMORY_BYTES, dir=flask_app.config["UPLOAD_FOLDER"]
+    )
+    length = 0
+    pending = []
+    pending_bytes = 0
+    more_body = True
+    while more_body:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            body.close()
+            return None, 0
+        chunk = message.get("body", b"")
+        more_body = message.get("more_body", False)
+        length += len(chunk)
+        if limit is not None and length > limit:
+            body.close()
+            return tempfile.SpooledTemporaryFile(), length
+        pending.append(chunk)
+        pending_bytes += len(chunk)
+        if pending_bytes >= ASGI_CHUNK_BYTES or (pending_bytes and not more_body):
+            await asyncio.to_thread(body.write, b"".join(pending))
+            pending, pending_bytes = [], 0
+    body.seek(0)
+    return body, length
+
+
+def _call_wsgi(environ):
+    """Runs the Flask app up to the point where it returns its response body."""
+    started = {}
+
+    def start_response(status, headers, exc_info=None):
+        started["status"] = status
+        started["headers"] = headers
+        return lambda data: started.setdefault("written", []).append(data)
+
+    body = flask_app(environ, start_response)
+    return started, body
+
+
+def _read_batch(iterator, size):
+    """Pulls chunks from a response body until about size bytes are collected."""
+    chunks = []
+    total = 0
+    for chunk in iterator:
+        if chunk:
+            chunks.append(chunk)
+            total += len(chunk)
+            if total >= size:
+                break
+    return b"".join(chunks)
+
+
+async def _watch_disconnect(receive, disconnected):
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            disconnected.set()
+            return
+
+
+async def _send_body(send, body, written, disconnected):
+    shaped = body if isinstance(body, ratelimit.ShapedBody) else None
+    source = shaped.body if shaped else body
+    if hasattr(source, "buffer_size"):  # Werkzeug's FileWrapper: read bigger blocks
+        source.buffer_size = ASGI_CHUNK_BYTES
+    for data in written:
+        await send({"type": "http.response.body", "body": data, "more_body": True})
+    if isinstance(source, (list, tuple)):
+        for data in source:
+            await send({"type": "http.response.body", "body": data, "more_body": True})
+    else:
+        iterator = iter(source)
+        while not disconnected.is_set():
+            data = await asyncio.to_thread(_read_batch, iterator, ASGI_CHUNK_BYTES)
+            if not data:
+                break
+            await send({"type": "http.response.body", "body": data, "more_body": True})
+            if shaped:
+                # Same accounting as ShapedBody, but the wait happens on the loop
+                shaped.unpaid += len(data)
+                if shaped.unpaid >= ratelimit.RATE_LIMIT_QUANTUM_BYTES:
+                    delay = await asyncio.to_thread(
+                        shaped.stream.acquire, shaped.unpaid, False
+                    )
+                    shaped.unpaid = 0
+                    if delay > 0:
+                        ratelimit.THROTTLE_SECONDS.inc(delay)
+                        await asyncio.sleep(delay)
+    await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+
+async def _handle_http(scope, receive, send):
+    body, length = await _receive_body(scope, receive)
+    if body is None:
+        return  # The client went away mid-request
+    try:
+        environ = _build_environ(scope, body, length)
+        started, response_body = await asyncio.to_thread(_call_wsgi, environ)
+    finally:
+        body.close()
+    disconnected = asyncio.Event()
+    watcher = asyncio.create_task(_watch_disconnect(receive, disconnected))
+    try:
+        status = int(started["status"].split(" ", 1)[0])
+        headers = [
+            (name.lower().encode("latin1"), value.encode("latin1"))
+            for name, value in started["headers"]
+        ]
+        await send(
+            {"type": "http.response.start", "status": status, "headers": headers}
+        )
+        await _send_body(send, response_body, started.get("written", []), disconnected)
+    finally:
+        watcher.cancel()
+        # Runs the view's on-close hooks (metrics, download stats, rate limit slot)
+        if hasattr(response_body, "close"):
+            await asyncio.to_thread(response_body.close)
+
+
+async def _handle_lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            asyncio.get_running_loop().set_default_executor(
+                ThreadPoolExecutor(max_workers=ASGI_THREADS, thread_name_prefix="asgi")
+            )
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    """ASGI entry point."""
+    if scope["type"] == "http":
+        await _handle_http(scope, receive, send)
+    elif scope["type"] == "lifespan":
+        await _handle_lifespan(receive, send)
+
+
+# --- Main Execution ---
+if __name__ == "__main__":
+    import uvicorn
+
+    uvicorn.run("webapp.asgi:app", host="0.0.0.0", port=5000)
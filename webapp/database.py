@@ -1,25 +1,212 @@
 import sqlite3
 import os
+import re
+import time
+import functools
+import threading
+from contextlib import contextmanager
 from datetime import datetime, timedelta, timezone
+from prometheus_client import Counter, Histogram
+import webapp.metrics as metrics
+import webapp.tracing as tracing
 
 DATABASE_PATH = os.getenv("DATABASE_PATH", "../data/database/metadata.db")
 UPLOAD_TOKEN_EXPIRY_SECONDS = int(os.getenv("UPLOAD_TOKEN_EXPIRY_SECONDS", 3600))
+# How long a statement keeps retrying while another process holds the write lock
+DB_BUSY_TIMEOUT_SECONDS = float(os.getenv("DB_BUSY_TIMEOUT_SECONDS", 5))
+# Version of the schema created by init_db(), stored in PRAGMA user_version.
+# Bump it whenever init_db() changes, so existing databases are upgraded.
+SCHEMA_VERSION = 2
 
-# Ensure the directory for the database exists
-os.makedirs(os.path.dirname(DATABASE_PATH), exist_ok=True)
+_schema_lock = threading.Lock()
+_schema_ready = False
 
 
-def get_db():
-    """Establishes a connection to the SQLite database."""
-    conn = sqlite3.connect(DATABASE_PATH)
+class QuotaExceeded(Exception):
+    """Raised when committing an upload would take a user or channel over quota."""
+
+
+# --- Metrics ---
+DB_QUERY_LATENCY = Histogram(
+    "db_query_duration_seconds",
+    "Time spent in each database.py function.",
+    ["query"],
+    buckets=metrics.DB_LATENCY_BUCKETS,
+)
+DB_LOCK_WAITS = Counter(
+    "db_lock_waits_total",
+    "SQLite statements or commits that had to wait for a lock held by another connection.",
+)
+DB_LOCK_WAIT_SECONDS = Counter(
+    "db_lock_wait_seconds_total",
+    "Total time spent waiting for SQLite locks.",
+)
+
+
+def _timed(func):
+    """Records the latency of a database function and traces it as a span."""
+    latency = DB_QUERY_LATENCY.labels(func.__name__)
+    span_name = f"db.{func.__name__}"
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with tracing.span(span_name):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                latency.observe(time.perf_counter() - start)
+
+    return wrapper
+
+
+def _wait_for_lock(operation, *args):
+    """Runs a sqlite3 call, retrying while the database is locked.
+
+    SQLite's own busy handler is invisible from Python, so connections are
+    opened with timeout=0 and the waiting is done here where it can be counted.
+    """
+    try:
+        return operation(*args)
+    except sqlite3.OperationalError as e:
+        if "locked" not in str(e):
+            raise
+    DB_LOCK_WAITS.inc()
+    start = time.monotonic()
+    delay = 0.001
+    try:
+        while True:
+            time.sleep(delay)
+            try:
+                return operation(*args)
+            except sqlite3.OperationalError as e:
+                if (
+                    "locked" not in str(e)
+                    or time.monotonic() - start >= DB_BUSY_TIMEOUT_SECONDS
+                ):
+                    raise
+            delay = min(delay * 2, 0.05)
+    finally:
+        DB_LOCK_WAIT_SECONDS.inc(time.monotonic() - start)
+
+
+class _Cursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        return _wait_for_lock(super().execute, sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        # Retrying re-runs every row, so the rows must be a re-iterable sequence
+        return _wait_for_lock(super().executemany, sql, list(seq_of_parameters))
+
+
+class _Connection(sqlite3.Connection):
+    def cursor(self, factory=_Cursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def commit(self):
+        return _wait_for_lock(super().commit)
+
+
+def _connect():
+    conn = sqlite3.connect(DATABASE_PATH, timeout=0, factory=_Connection)
     conn.row_factory = sqlite3.Row  # Return rows as dictionary-like objects
     return conn
 
 
-def init_db():
-    """Initializes the database and creates tables if they don't exist."""
+def get_db():
+    """Establishes a connection to the SQLite database.
+
+    The first connection in a process makes sure the schema is up to date.
+    """
+    if not _schema_ready:
+        init_db()
+    return _connect()
+
+
+@contextmanager
+def transaction():
+    """Unit of work: yields a connection whose statements commit (or roll back) together.
+
+    The write lock is taken up front with BEGIN IMMEDIATE, so the block cannot
+    fail halfway through on a lock upgrade, and everything costs one commit.
+    """
     conn = get_db()
-    cursor = conn.cursor()
+    conn.isolation_level = None  # Transactions are managed explicitly here
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.rollback()
+            raise
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def parse_timestamp(value):
+    """Parses a timestamp stored by this module into an aware UTC datetime."""
+    if value is None:
+        return None
+    if isinstance(value, datetime):
+        parsed = value
+    else:
+        parsed = datetime.fromisoformat(str(value))
+    if parsed.tzinfo is None:  # CURRENT_TIMESTAMP values are naive UTC
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed
+
+
+@_timed
+def init_db():
+    """Creates or upgrades the schema unless the database is at SCHEMA_VERSION.
+
+    Importing this module does not touch the database; get_db() calls this on
+    a process's first connection. For an up-to-date database that costs one
+    PRAGMA read, so the DDL runs once per deployment rather than in every
+    process and worker.
+    """
+    global _schema_ready
+    with _schema_lock:
+        if _schema_ready:
+            return
+        os.makedirs(os.path.dirname(DATABASE_PATH) or ".", exist_ok=True)
+        conn = _connect()
+        try:
+            if _schema_version(conn) >= SCHEMA_VERSION:
+                _schema_ready = True
+                return
+            conn.isolation_level = None  # One explicit transaction for all of it
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                # Another process may have created it while this one waited
+                created = _schema_version(conn) < SCHEMA_VERSION
+                if created:
+                    _create_schema(conn.cursor())
+                    conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+            except BaseException:
+                conn.rollback()
+                raise
+            conn.commit()
+        finally:
+            conn.close()
+        _schema_ready = True
+    if created:
+        print(f"Database initialized (schema version {SCHEMA_VERSION}).")
+
+
+def _schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def _create_schema(cursor):
+    """Runs the DDL (and one-off backfills) inside init_db's transaction."""
     # Create upload_tokens table
     cursor.execute(
         """
@@ -63,14 +250,169 @@ def init_db():
     )
     # Index for faster lookup? Optional.
     # cursor.execute('CREATE INDEX IF NOT EXISTS idx_notifications_created ON bot_notifications (created_at);')
-    conn.commit()
-    conn.close()
-    print("Database initialized (including bot_notifications table).")
+    # Create quota_usage table (running byte totals per user / channel)
+    cursor.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'quota_usage'"
+    )
+    quota_table_exists = cursor.fetchone() is not None
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS quota_usage (
+            scope TEXT NOT NULL, -- 'user' or 'channel'
+            scope_id TEXT NOT NULL,
+            bytes_used INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (scope, scope_id)
+        )
+    """
+    )
+    if not quota_table_exists:
+        # One-off backfill for databases created before quotas were tracked
+        for scope, column in (
+            ("user", "context_user_id"),
+            ("channel", "context_channel_id"),
+        ):
+            cursor.execute(
+                f"""INSERT INTO quota_usage (scope, scope_id, bytes_used)
+                    SELECT ?, {column}, COALESCE(SUM(file_size), 0)
+                    FROM uploads GROUP BY {column}""",
+                (scope,),
+            )
+    # Create previews table (derivatives such as thumbnails and text snippets)
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS previews (
+            file_id TEXT PRIMARY KEY,
+            status TEXT NOT NULL, -- 'pending', 'ready', 'unsupported', 'error', 'evicted'
+            kind TEXT, -- 'image' or 'text'
+            path TEXT,
+            content_type TEXT,
+            text TEXT,
+            size INTEGER NOT NULL DEFAULT 0,
+            created_at DATETIME NOT NULL
+        )
+    """
+    )
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_previews_status_created ON previews (status, created_at)"
+    )
+    # Indexes for listing a channel's / user's uploads newest first
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_uploads_channel_ts ON uploads (context_channel_id, upload_timestamp)"
+    )
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_uploads_user_ts ON uploads (context_user_id, upload_timestamp)"
+    )
+    # Index for retention sweeps that are not limited to one channel
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_uploads_ts ON uploads (upload_timestamp)"
+    )
+    # Create expired_uploads table (tombstones for /download's 410, and the
+    # stored files still to be deleted until purged_at is set)
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS expired_uploads (
+            file_id TEXT PRIMARY KEY,
+            expired_at DATETIME NOT NULL,
+            cached_path TEXT,
+            nas_path TEXT,
+            preview_path TEXT,
+            purged_at DATETIME
+        )
+    """
+    )
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_expired_unpurged ON expired_uploads (expired_at) WHERE purged_at IS NULL"
+    )
+    # Create download_stats table (per-file totals, flushed in batches by the webapp)
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS download_stats (
+            file_id TEXT PRIMARY KEY,
+            download_count INTEGER NOT NULL DEFAULT 0,
+            bytes_served INTEGER NOT NULL DEFAULT 0,
+            last_access DATETIME NOT NULL
+        )
+    """
+    )
+    # Create service_state table (small values services keep across restarts,
+    # e.g. the bot's last synced command tree)
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS service_state (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL,
+            updated_at DATETIME NOT NULL
+        )
+    """
+    )
+    # Full-text index over filenames, kept in sync with uploads by triggers.
+    # The channel and user IDs are indexed too, so a filtered search only
+    # walks that channel's (or user's) matches rather than every match.
+    # It references uploads by rowid, which VACUUM may renumber; run
+    # rebuild_search_index() after a VACUUM.
+    cursor.execute(
+        "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'uploads_fts'"
+    )
+    fts_table = cursor.fetchone()
+    if fts_table and "context_channel_id" not in fts_table[0]:
+        # Schema version 1 indexed filenames only; recreate it with the IDs
+        for trigger in (
+            "uploads_fts_insert",
+            "uploads_fts_delete",
+            "uploads_fts_update",
+        ):
+            cursor.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+        cursor.execute("DROP TABLE uploads_fts")
+        fts_table = None
+    cursor.execute(
+        """
+        CREATE VIRTUAL TABLE IF NOT EXISTS uploads_fts USING fts5(
+            original_filename,
+            context_channel_id,
+            context_user_id,
+            content='uploads',
+            prefix='1 2 3',
+            content_rowid='rowid',
+            tokenize='unicode61 remove_diacritics 2'
+        )
+    """
+    )
+    # One statement per execute(): executescript() would commit the transaction
+    cursor.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS uploads_fts_insert AFTER INSERT ON uploads BEGIN
+            INSERT INTO uploads_fts (rowid, original_filename, context_channel_id, context_user_id)
+            VALUES (new.rowid, new.original_filename, new.context_channel_id, new.context_user_id);
+        END
+    """
+    )
+    cursor.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS uploads_fts_delete AFTER DELETE ON uploads BEGIN
+            INSERT INTO uploads_fts (uploads_fts, rowid, original_filename, context_channel_id, context_user_id)
+            VALUES ('delete', old.rowid, old.original_filename, old.context_channel_id, old.context_user_id);
+        END
+    """
+    )
+    cursor.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS uploads_fts_update
+        AFTER UPDATE OF original_filename, context_channel_id, context_user_id ON uploads BEGIN
+            INSERT INTO uploads_fts (uploads_fts, rowid, original_filename, context_channel_id, context_user_id)
+            VALUES ('delete', old.rowid, old.original_filename, old.context_channel_id, old.context_user_id);
+            INSERT INTO uploads_fts (rowid, original_filename, context_channel_id, context_user_id)
+            VALUES (new.rowid, new.original_filename, new.context_channel_id, new.context_user_id);
+        END
+    """
+    )
+    if not fts_table:
+        cursor.execute("INSERT INTO uploads_fts (uploads_fts) VALUES ('rebuild')")
 
 
 # --- Token Functions ---
 
 
+@_timed
 def add_upload_token(token, context):
     """Adds a new upload token to the database."""
     conn = get_db()
@@ -96,6 +438,7 @@ def add_upload_token(token, context):
     return True
 
 
+@_timed
 def get_token_context(token):
     """Retrieves the context associated with a valid token."""
     conn = get_db()
@@ -115,11 +458,12 @@ def get_token_context(token):
     return None
 
 
+@_timed
 def delete_token(token):
     """Deletes a token from the database."""
     conn = get_db()
     try:
-        conn.execute("DELETE FROM upload_tokens WHERE token = ?", (token,))
+        _delete_token(conn, token)
         conn.commit()
     except sqlite3.Error as e:
         print(f"Database error deleting token: {e}")
@@ -127,6 +471,13 @@ def delete_token(token):
         conn.close()
 
 
+def _delete_token(conn, token):
+    """Deletes a token within conn's transaction. Returns True if it existed."""
+    cursor = conn.execute("DELETE FROM upload_tokens WHERE token = ?", (token,))
+    return cursor.rowcount == 1
+
+
+@_timed
 def cleanup_expired_tokens():
     """Removes expired tokens from the database."""
     conn = get_db()
@@ -146,28 +497,21 @@ def cleanup_expired_tokens():
 # --- Upload Metadata Functions ---
 
 
+@_timed
 def add_upload_record(
     file_id, original_filename, cached_path, context, content_type=None, file_size=None
 ):
     """Adds a record for a newly uploaded file."""
     conn = get_db()
-    now = datetime.now(timezone.utc)
     try:
-        conn.execute(
-            """INSERT INTO uploads (file_id, original_filename, cached_path, status, upload_timestamp,
-                                context_user_id, context_channel_id, content_type, file_size)
-               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-            (
-                file_id,
-                original_filename,
-                cached_path,
-                "cached",
-                now,
-                str(context.get("user_id")),
-                str(context.get("channel_id")),
-                content_type,
-                file_size,
-            ),
+        _insert_upload_record(
+            conn,
+            file_id,
+            original_filename,
+            cached_path,
+            context,
+            content_type,
+            file_size,
         )
         conn.commit()
     except sqlite3.Error as e:
@@ -178,6 +522,82 @@ def add_upload_record(
     return True
 
 
+def _insert_upload_record(
+    conn, file_id, original_filename, cached_path, context, content_type, file_size
+):
+    """Inserts an upload record and charges its size to the quotas within conn's transaction."""
+    conn.execute(
+        """INSERT INTO uploads (file_id, original_filename, cached_path, status, upload_timestamp,
+                            context_user_id, context_channel_id, content_type, file_size)
+           VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+        (
+            file_id,
+            original_filename,
+            cached_path,
+            "cached",
+            datetime.now(timezone.utc),
+            str(context.get("user_id")),
+            str(context.get("channel_id")),
+            content_type,
+            file_size,
+        ),
+    )
+    _add_quota_usage(
+        conn, context.get("user_id"), context.get("channel_id"), file_size or 0
+    )
+
+
+@_timed
+def commit_upload(
+    token,
+    file_id,
+    original_filename,
+    cached_path,
+    context,
+    content_type=None,
+    file_size=None,
+    user_quota=0,
+    channel_quota=0,
+):
+    """Records a finished upload atomically: consumes the token, adds the upload
+    record and queues the bot notification in a single transaction.
+
+    user_quota / channel_quota (bytes, 0 for none) are checked again inside the
+    transaction, so parallel uploads cannot each use the same remaining quota.
+    Raises QuotaExceeded (and changes nothing) if this upload would go over.
+    Returns False (and changes nothing) if the token was already used or on error.
+    """
+    try:
+        with transaction() as conn:
+            if not _delete_token(conn, token):
+                print(f"Upload token already used, not recording {file_id}.")
+                return False
+            if user_quota or channel_quota:
+                usage = _read_quota_usage(conn, context)
+                if (user_quota and usage["user"] + (file_size or 0) > user_quota) or (
+                    channel_quota
+                    and usage["channel"] + (file_size or 0) > channel_quota
+                ):
+                    raise QuotaExceeded(
+                        f"Upload {file_id} of {file_size} bytes exceeds the quota."
+                    )
+            _insert_upload_record(
+                conn,
+                file_id,
+                original_filename,
+                cached_path,
+                context,
+                content_type,
+                file_size,
+            )
+            _insert_bot_notification(conn, file_id, context, original_filename)
+    except sqlite3.Error as e:
+        print(f"Database error committing upload {file_id}: {e}")
+        return False
+    return True
+
+
+@_timed
 def get_upload_record(file_id):
     """Retrieves an upload record by file_id."""
     conn = get_db()
@@ -188,11 +608,20 @@ def get_upload_record(file_id):
     return row  # Returns a Row object or None
 
 
-def update_upload_status(file_id, status, nas_path=None):
-    """Updates the status and optionally the NAS path of an upload record."""
+@_timed
+def update_upload_status(file_id, status, nas_path=None, drop_cached_path=False):
+    """Updates the status and optionally the NAS path of an upload record.
+
+    drop_cached_path clears cached_path, for files moved out of the cache.
+    """
     conn = get_db()
     try:
-        if nas_path:
+        if drop_cached_path:
+            conn.execute(
+                "UPDATE uploads SET status = ?, nas_path = COALESCE(?, nas_path), cached_path = NULL WHERE file_id = ?",
+                (status, nas_path, file_id),
+            )
+        elif nas_path:
             conn.execute(
                 "UPDATE uploads SET status = ?, nas_path = ? WHERE file_id = ?",
                 (status, nas_path, file_id),
@@ -210,6 +639,7 @@ def update_upload_status(file_id, status, nas_path=None):
     return True
 
 
+@_timed
 def get_uploads_by_status(status):
     """Retrieves all upload records with a specific status."""
     conn = get_db()
@@ -220,11 +650,71 @@ def get_uploads_by_status(status):
     return rows  # Returns a list of Row objects
 
 
+@_timed
+def get_cached_paths():
+    """Returns the set of cached_path values referenced by any upload record."""
+    conn = get_db()
+    try:
+        cursor = conn.execute(
+            "SELECT cached_path FROM uploads WHERE cached_path IS NOT NULL"
+        )
+        return {row[0] for row in cursor.fetchall()}
+    except sqlite3.Error as e:
+        print(f"Database error getting cached paths: {e}")
+        return None
+    finally:
+        conn.close()
+
+
+@_timed
+def reset_interrupted_uploads():
+    """Returns uploads stuck in 'uploading_to_nas' (e.g. after a crash) to 'cached'."""
+    conn = get_db()
+    try:
+        cursor = conn.execute(
+            "UPDATE uploads SET status = 'cached' WHERE status = 'uploading_to_nas'"
+        )
+        conn.commit()
+        return cursor.rowcount
+    except sqlite3.Error as e:
+        print(f"Database error resetting interrupted uploads: {e}")
+        return 0
+    finally:
+        conn.close()
+
+
+@_timed
+def count_uploads_by_status():
+    """Returns a mapping of upload status to the number of records in it."""
+    conn = get_db()
+    try:
+        cursor = conn.execute("SELECT status, COUNT(*) FROM uploads GROUP BY status")
+        return {row[0]: row[1] for row in cursor.fetchall()}
+    except sqlite3.Error as e:
+        print(f"Database error counting uploads by status: {e}")
+        return {}
+    finally:
+        conn.close()
+
+
+@_timed
 def delete_upload_record(file_id):
     """Deletes an upload record (use with caution)."""
     conn = get_db()
     try:
+        row = conn.execute(
+            "SELECT context_user_id, context_channel_id, file_size FROM uploads WHERE file_id = ?",
+            (file_id,),
+        ).fetchone()
         conn.execute("DELETE FROM uploads WHERE file_id = ?", (file_id,))
+        conn.execute("DELETE FROM download_stats WHERE file_id = ?", (file_id,))
+        if row:
+            _add_quota_usage(
+                conn,
+                row["context_user_id"],
+                row["context_channel_id"],
+                -(row["file_size"] or 0),
+            )
         conn.commit()
     except sqlite3.Error as e:
         print(f"Database error deleting upload record {file_id}: {e}")
@@ -234,23 +724,543 @@ def delete_upload_record(file_id):
     return True
 
 
+# --- Listing and Search Functions ---
+
+LISTING_COLUMNS = """u.rowid AS row_id, u.file_id, u.original_filename, u.status,
+    u.upload_timestamp, u.context_user_id, u.context_channel_id, u.file_size"""
+
+
+def _page(rows, limit, cursor_of):
+    """Splits limit+1 fetched rows into a page and the cursor for the next one."""
+    if len(rows) > limit:
+        return rows[:limit], cursor_of(rows[limit - 1])
+    return rows, None
+
+
+@_timed
+def list_uploads(channel_id=None, user_id=None, after=None, limit=10):
+    """Lists uploads newest first for a channel and/or user, using keyset pagination.
+
+    `after` is the cursor returned with the previous page. Returns (rows, next_cursor);
+    next_cursor is None on the last page.
+    """
+    clauses, params = [], []
+    if channel_id is not None:
+        clauses.append("u.context_channel_id = ?")
+        params.append(str(channel_id))
+    if user_id is not None:
+        clauses.append("u.context_user_id = ?")
+        params.append(str(user_id))
+    if after is not None:
+        # Row-value comparison continues exactly where the last page stopped
+        clauses.append("(u.upload_timestamp, u.rowid) < (?, ?)")
+        params.extend(after)
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+    conn = get_db()
+    try:
+        rows = conn.execute(
+            f"""SELECT {LISTING_COLUMNS} FROM uploads u {where}
+                ORDER BY u.upload_timestamp DESC, u.rowid DESC LIMIT ?""",
+            (*params, limit + 1),
+        ).fetchall()
+    except sqlite3.Error as e:
+        print(f"Database error listing uploads: {e}")
+        return [], None
+    finally:
+        conn.close()
+    return _page(rows, limit, lambda row: (row["upload_timestamp"], row["row_id"]))
+
+
+def _fts_query(text, channel_id=None, user_id=None):
+    """Turns free text into an FTS5 query matching every word as a prefix of
+    the filename, limited to the given channel and user if set."""
+    words = re.findall(r"\w+", text)
+    if not words:
+        return ""
+    query = "original_filename : ({})".format(" ".join(f'"{word}"*' for word in words))
+    for column, value in (
+        ("context_channel_id", channel_id),
+        ("context_user_id", user_id),
+    ):
+        if value is not None:
+            query += ' AND {} : "{}"'.format(column, str(value).replace('"', '""'))
+    return query
+
+
+@_timed
+def search_uploads(text, channel_id=None, user_id=None, after=None, limit=10):
+    """Searches original filenames, newest first, with keyset pagination.
+
+    Returns (rows, next_cursor) like list_uploads.
+    """
+    query = _fts_query(text, channel_id, user_id)
+    if not query:
+        return [], None
+    clauses, params = ["uploads_fts MATCH ?"], [query]
+    if after is not None:
+        # FTS rowids follow insertion order, so rowid DESC is newest first
+        clauses.append("f.rowid < ?")
+        params.append(after)
+    conn = get_db()
+    try:
+        rows = conn.execute(
+            f"""SELECT {LISTING_COLUMNS} FROM uploads_fts f
+                JOIN uploads u ON u.rowid = f.rowid
+                WHERE {' AND '.join(clauses)}
+                ORDER BY f.rowid DESC LIMIT ?""",
+            (*params, limit + 1),
+        ).fetchall()
+    except sqlite3.Error as e:
+        print(f"Database error searching uploads: {e}")
+        return [], None
+    finally:
+        conn.close()
+    return _page(rows, limit, lambda row: row["row_id"])
+
+
+@_timed
+def rebuild_search_index():
+    """Rebuilds the filename search index from the uploads table."""
+    conn = get_db()
+    try:
+        conn.execute("INSERT INTO uploads_fts (uploads_fts) VALUES ('rebuild')")
+        conn.commit()
+    except sqlite3.Error as e:
+        print(f"Database error rebuilding search index: {e}")
+        return False
+    finally:
+        conn.close()
+    return True
+
+
+# --- Retention Functions ---
+
+
+@_timed
+def expire_uploads(
+    cutoff,
+    limit,
+    channel_id=None,
+    exclude_channel_ids=(),
+    min_size=None,
+    max_size=None,
+):
+    """Expires up to limit uploads older than cutoff in a single transaction.
+
+    Matching uploads are removed together with their preview and any pending
+    notification, and recorded in expired_uploads so their files can be purged.
+    Uploads currently being copied to the NAS are skipped. Sizes are matched as
+    min_size <= file_size < max_size. Returns the number expired, or None on error.
+    """
+    clauses = ["u.upload_timestamp < ?", "u.status != 'uploading_to_nas'"]
+    params = [cutoff]
+    if channel_id is not None:
+        clauses.append("u.context_channel_id = ?")
+        params.append(str(channel_id))
+    if exclude_channel_ids:
+        placeholders = ", ".join("?" * len(exclude_channel_ids))
+        clauses.append(f"u.context_channel_id NOT IN ({placeholders})")
+        params.extend(str(c) for c in exclude_channel_ids)
+    if min_size is not None:
+        clauses.append("COALESCE(u.file_size, 0) >= ?")
+        params.append(min_size)
+    if max_size is not None:
+        clauses.append("COALESCE(u.file_size, 0) < ?")
+        params.append(max_size)
+    try:
+        with transaction() as conn:
+            rows = conn.execute(
+                f"""SELECT u.file_id, u.cached_path, u.nas_path, u.file_size,
+                           u.context_user_id, u.context_channel_id,
+                           p.path AS preview_path, p.size AS preview_size
+                    FROM uploads u LEFT JOIN previews p ON p.file_id = u.file_id
+                    WHERE {" AND ".join(clauses)}
+                    ORDER BY u.upload_timestamp LIMIT ?""",
+                (*params, limit),
+            ).fetchall()
+            if not rows:
+                return 0
+            now = datetime.now(timezone.utc)
+            file_ids = [(row["file_id"],) for row in rows]
+            conn.executemany(
+                """INSERT OR REPLACE INTO expired_uploads
+                   (file_id, expired_at, cached_path, nas_path, preview_path)
+                   VALUES (?, ?, ?, ?, ?)""",
+                [
+                    (
+                        row["file_id"],
+                        now,
+                        row["cached_path"],
+                        row["nas_path"],
+                        row["preview_path"],
+                    )
+                    for row in rows
+                ],
+            )
+            conn.executemany("DELETE FROM uploads WHERE file_id = ?", file_ids)
+            conn.executemany("DELETE FROM previews WHERE file_id = ?", file_ids)
+            conn.executemany(
+                "DELETE FROM bot_notifications WHERE file_id = ?", file_ids
+            )
+            conn.executemany("DELETE FROM download_stats WHERE file_id = ?", file_ids)
+            # Release quotas with one update per user / channel, not per row
+            freed = {}
+            for row in rows:
+                for key in (
+                    ("user", row["context_user_id"]),
+                    ("channel", row["context_channel_id"]),
+                ):
+                    freed[key] = freed.get(key, 0) + (row["file_size"] or 0)
+            for (scope, scope_id), size in freed.items():
+                _adjust_usage(conn, scope, scope_id, -size)
+            preview_bytes = sum(row["preview_size"] or 0 for row in rows)
+            if preview_bytes:
+                _adjust_usage(conn, "cache", "previews", -preview_bytes)
+    except sqlite3.Error as e:
+        print(f"Database error expiring uploads: {e}")
+        return None
+    return len(rows)
+
+
+@_timed
+def get_unpurged_expired(limit, after=None):
+    """Retrieves expired uploads whose stored files have not been deleted yet.
+
+    Pass the (expired_at, row_id) of the last row seen as after to continue
+    past records that could not be purged.
+    """
+    conn = get_db()
+    try:
+        if after is None:
+            after = ("", 0)
+        return conn.execute(
+            """SELECT rowid AS row_id, * FROM expired_uploads
+               WHERE purged_at IS NULL AND (expired_at, rowid) > (?, ?)
+               ORDER BY expired_at, rowid LIMIT ?""",
+            (*after, limit),
+        ).fetchall()
+    except sqlite3.Error as e:
+        print(f"Database error getting unpurged expired uploads: {e}")
+        return []
+    finally:
+        conn.close()
+
+
+@_timed
+def mark_expired_purged(file_ids):
+    """Records that the stored files of these expired uploads have been deleted."""
+    conn = get_db()
+    try:
+        conn.executemany(
+            """UPDATE expired_uploads
+               SET purged_at = ?, cached_path = NULL, nas_path = NULL, preview_path = NULL
+               WHERE file_id = ?""",
+            [(datetime.now(timezone.utc), file_id) for file_id in file_ids],
+        )
+        conn.commit()
+    except sqlite3.Error as e:
+        print(f"Database error marking expired uploads purged: {e}")
+        return False
+    finally:
+        conn.close()
+    return True
+
+
+@_timed
+def get_expired_at(file_id):
+    """Returns when an upload expired, or None if it has not expired."""
+    conn = get_db()
+    try:
+        row = conn.execute(
+            "SELECT expired_at FROM expired_uploads WHERE file_id = ?", (file_id,)
+        ).fetchone()
+        return row["expired_at"] if row else None
+    except sqlite3.Error as e:
+        print(f"Database error checking expiry of {file_id}: {e}")
+        return None
+    finally:
+        conn.close()
+
+
+# --- Download Stats Functions ---
+
+
+@_timed
+def add_download_stats(entries):
+    """Adds buffered download counts in one transaction.
+
+    entries is a list of (file_id, download_count, bytes_served, last_access).
+    """
+    try:
+        with transaction() as conn:
+            conn.executemany(
+                """INSERT INTO download_stats (file_id, download_count, bytes_served, last_access)
+                   VALUES (?, ?, ?, ?)
+                   ON CONFLICT (file_id) DO UPDATE SET
+                       download_count = download_count + excluded.download_count,
+                       bytes_served = bytes_served + excluded.bytes_served,
+                       last_access = MAX(last_access, excluded.last_access)""",
+                entries,
+            )
+    except sqlite3.Error as e:
+        print(f"Database error adding download stats: {e}")
+        return False
+    return True
+
+
+@_timed
+def get_download_stats(file_id):
+    """Retrieves an upload joined with its download stats (Row or None)."""
+    conn = get_db()
+    try:
+        return conn.execute(
+            """SELECT u.file_id, u.original_filename, u.upload_timestamp, u.file_size,
+                      u.context_channel_id,
+                      COALESCE(s.download_count, 0) AS download_count,
+                      COALESCE(s.bytes_served, 0) AS bytes_served, s.last_access
+               FROM uploads u LEFT JOIN download_stats s ON s.file_id = u.file_id
+               WHERE u.file_id = ?""",
+            (file_id,),
+        ).fetchone()
+    except sqlite3.Error as e:
+        print(f"Database error getting download stats for {file_id}: {e}")
+        return None
+    finally:
+        conn.close()
+
+
+@_timed
+def get_channel_download_stats(channel_id, limit=5):
+    """Returns a channel's download totals and its most downloaded uploads.
+
+    Returns (totals, top_rows), or (None, []) on error.
+    """
+    conn = get_db()
+    try:
+        totals = conn.execute(
+            """SELECT COUNT(*) AS uploads,
+                      COALESCE(SUM(u.file_size), 0) AS bytes_stored,
+                      COALESCE(SUM(s.download_count), 0) AS download_count,
+                      COALESCE(SUM(s.bytes_served), 0) AS bytes_served,
+                      MAX(s.last_access) AS last_access
+               FROM uploads u LEFT JOIN download_stats s ON s.file_id = u.file_id
+               WHERE u.context_channel_id = ?""",
+            (str(channel_id),),
+        ).fetchone()
+        top = conn.execute(
+            """SELECT u.file_id, u.original_filename, s.download_count, s.bytes_served,
+                      s.last_access
+               FROM uploads u JOIN download_stats s ON s.file_id = u.file_id
+               WHERE u.context_channel_id = ?
+               ORDER BY s.download_count DESC, s.last_access DESC LIMIT ?""",
+            (str(channel_id), limit),
+        ).fetchall()
+        return totals, top
+    except sqlite3.Error as e:
+        print(f"Database error getting download stats for channel {channel_id}: {e}")
+        return None, []
+    finally:
+        conn.close()
+
+
+# --- Quota Functions ---
+
+
+def _adjust_usage(conn, scope, scope_id, delta):
+    """Adjusts a running byte total in quota_usage within conn's transaction."""
+    conn.execute(
+        """INSERT INTO quota_usage (scope, scope_id, bytes_used) VALUES (?, ?, ?)
+           ON CONFLICT (scope, scope_id) DO UPDATE SET bytes_used = MAX(0, bytes_used + excluded.bytes_used)""",
+        (scope, str(scope_id), delta),
+    )
+
+
+def _add_quota_usage(conn, user_id, channel_id, delta):
+    """Adjusts the running byte totals for a user and channel within conn's transaction."""
+    _adjust_usage(conn, "user", user_id, delta)
+    _adjust_usage(conn, "channel", channel_id, delta)
+
+
+def _read_quota_usage(conn, context):
+    cursor = conn.execute(
+        """SELECT scope, bytes_used FROM quota_usage
+           WHERE (scope = 'user' AND scope_id = ?) OR (scope = 'channel' AND scope_id = ?)""",
+        (str(context.get("user_id")), str(context.get("channel_id"))),
+    )
+    usage = {"user": 0, "channel": 0}
+    usage.update({row["scope"]: row["bytes_used"] for row in cursor.fetchall()})
+    return usage
+
+
+@_timed
+def get_quota_usage(context):
+    """Returns the bytes currently stored for the context's user and channel."""
+    conn = get_db()
+    try:
+        return _read_quota_usage(conn, context)
+    except sqlite3.Error as e:
+        print(f"Database error getting quota usage: {e}")
+        return None
+    finally:
+        conn.close()
+
+
+# --- Preview Functions ---
+
+
+@_timed
+def claim_preview(file_id, stale_before):
+    """Marks a preview as being generated. Returns False if it is already done or
+    claimed by another worker since stale_before."""
+    conn = get_db()
+    try:
+        cursor = conn.execute(
+            """INSERT INTO previews (file_id, status, created_at) VALUES (?, 'pending', ?)
+               ON CONFLICT (file_id) DO UPDATE SET created_at = excluded.created_at
+               WHERE previews.status = 'pending' AND previews.created_at < ?""",
+            (file_id, datetime.now(timezone.utc), stale_before),
+        )
+        conn.commit()
+        return cursor.rowcount == 1
+    except sqlite3.Error as e:
+        print(f"Database error claiming preview for {file_id}: {e}")
+        return False
+    finally:
+        conn.close()
+
+
+@_timed
+def finish_preview(
+    file_id, status, kind=None, path=None, content_type=None, text=None, size=0
+):
+    """Stores the outcome of preview generation and counts its size in the preview cache."""
+    conn = get_db()
+    try:
+        conn.execute(
+            """UPDATE previews SET status = ?, kind = ?, path = ?, content_type = ?, text = ?, size = ?
+               WHERE file_id = ?""",
+            (status, kind, path, content_type, text, size, file_id),
+        )
+        if size:
+            _adjust_usage(conn, "cache", "previews", size)
+        conn.commit()
+    except sqlite3.Error as e:
+        print(f"Database error finishing preview for {file_id}: {e}")
+        return False
+    finally:
+        conn.close()
+    return True
+
+
+@_timed
+def get_preview(file_id):
+    """Retrieves the preview record for an upload (Row or None)."""
+    conn = get_db()
+    try:
+        return conn.execute(
+            "SELECT * FROM previews WHERE file_id = ?", (file_id,)
+        ).fetchone()
+    except sqlite3.Error as e:
+        print(f"Database error getting preview for {file_id}: {e}")
+        return None
+    finally:
+        conn.close()
+
+
+@_timed
+def get_uploads_without_preview(stale_before, limit):
+    """Retrieves cached uploads that have no preview yet, or an abandoned claim."""
+    conn = get_db()
+    try:
+        return conn.execute(
+            """SELECT u.* FROM uploads u LEFT JOIN previews p ON p.file_id = u.file_id
+               WHERE u.cached_path IS NOT NULL
+                 AND (p.file_id IS NULL OR (p.status = 'pending' AND p.created_at < ?))
+               LIMIT ?""",
+            (stale_before, limit),
+        ).fetchall()
+    except sqlite3.Error as e:
+        print(f"Database error getting uploads without preview: {e}")
+        return []
+    finally:
+        conn.close()
+
+
+@_timed
+def get_preview_cache_bytes():
+    """Returns the total size of stored preview files."""
+    conn = get_db()
+    try:
+        row = conn.execute(
+            "SELECT bytes_used FROM quota_usage WHERE scope = 'cache' AND scope_id = 'previews'"
+        ).fetchone()
+        return row[0] if row else 0
+    except sqlite3.Error as e:
+        print(f"Database error getting preview cache size: {e}")
+        return 0
+    finally:
+        conn.close()
+
+
+@_timed
+def get_oldest_previews(limit):
+    """Retrieves the least recently used preview files (eviction candidates).
+
+    Uploads that have never been downloaded count from when their preview was made.
+    """
+    conn = get_db()
+    try:
+        return conn.execute(
+            """SELECT p.file_id, p.path, p.size FROM previews p
+               LEFT JOIN download_stats s ON s.file_id = p.file_id
+               WHERE p.status = 'ready' AND p.path IS NOT NULL
+               ORDER BY COALESCE(s.last_access, p.created_at) ASC LIMIT ?""",
+            (limit,),
+        ).fetchall()
+    except sqlite3.Error as e:
+        print(f"Database error getting oldest previews: {e}")
+        return []
+    finally:
+        conn.close()
+
+
+@_timed
+def mark_preview_evicted(file_id):
+    """Marks a preview whose file was removed from the cache as evicted.
+
+    Its size is released from the cache usage only by the call that actually
+    changed it from 'ready', so concurrent evictions cannot count it twice.
+    """
+    try:
+        with transaction() as conn:
+            row = conn.execute(
+                "SELECT size FROM previews WHERE file_id = ? AND status = 'ready'",
+                (file_id,),
+            ).fetchone()
+            if row is None:
+                return True  # Already evicted by another worker
+            cursor = conn.execute(
+                """UPDATE previews SET status = 'evicted', path = NULL, size = 0
+                   WHERE file_id = ? AND status = 'ready'""",
+                (file_id,),
+            )
+            if cursor.rowcount == 1:
+                _adjust_usage(conn, "cache", "previews", -row["size"])
+    except sqlite3.Error as e:
+        print(f"Database error evicting preview {file_id}: {e}")
+        return False
+    return True
+
+
 # --- Bot Notification Functions ---
 
 
+@_timed
 def add_bot_notification(file_id, context, original_filename):
     """Adds a notification for the bot to process."""
     conn = get_db()
     try:
-        conn.execute(
-            """INSERT INTO bot_notifications (file_id, channel_id, user_id, original_filename)
-               VALUES (?, ?, ?, ?)""",
-            (
-                file_id,
-                str(context.get("channel_id")),
-                str(context.get("user_id")),
-                original_filename,
-            ),
-        )
+        _insert_bot_notification(conn, file_id, context, original_filename)
         conn.commit()
     except sqlite3.Error as e:
         print(f"Database error adding bot notification for {file_id}: {e}")
@@ -260,6 +1270,20 @@ def add_bot_notification(file_id, context, original_filename):
     return True
 
 
+def _insert_bot_notification(conn, file_id, context, original_filename):
+    conn.execute(
+        """INSERT INTO bot_notifications (file_id, channel_id, user_id, original_filename)
+           VALUES (?, ?, ?, ?)""",
+        (
+            file_id,
+            str(context.get("channel_id")),
+            str(context.get("user_id")),
+            original_filename,
+        ),
+    )
+
+
+@_timed
 def get_pending_notifications():
     """Retrieves all pending bot notifications."""
     conn = get_db()
@@ -275,6 +1299,7 @@ def get_pending_notifications():
         conn.close()
 
 
+@_timed
 def delete_notification(notification_id):
     """Deletes a processed notification by its ID."""
     conn = get_db()
@@ -292,5 +1317,40 @@ def delete_notification(notification_id):
     return True
 
 
-# Initialize the database when this module is loaded
-init_db()
+# --- Service State Functions ---
+
+
+@_timed
+def get_service_state(key):
+    """Returns the stored value for key, or None."""
+    conn = get_db()
+    try:
+        row = conn.execute(
+            "SELECT value FROM service_state WHERE key = ?", (key,)
+        ).fetchone()
+        return row["value"] if row else None
+    except sqlite3.Error as e:
+        print(f"Database error getting service state {key}: {e}")
+        return None
+    finally:
+        conn.close()
+
+
+@_timed
+def set_service_state(key, value):
+    """Stores value under key, replacing any previous value."""
+    conn = get_db()
+    try:
+        conn.execute(
+            """INSERT INTO service_state (key, value, updated_at) VALUES (?, ?, ?)
+               ON CONFLICT (key) DO UPDATE SET value = excluded.value,
+                                               updated_at = excluded.updated_at""",
+            (key, value, datetime.now(timezone.utc)),
+        )
+        conn.commit()
+    except sqlite3.Error as e:
+        print(f"Database error setting service state {key}: {e}")
+        return False
+    finally:
+        conn.close()
+    return True
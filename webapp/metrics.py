@@ -0,0 +1,93 @@
+import os
+import logging
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    generate_latest,
+    start_http_server,
+)
+from prometheus_client import multiprocess
+
+# Shared Prometheus helpers for the webapp, uploader and bot.
+# Each service defines its own metrics next to the code it measures and uses
+# these helpers to expose them over HTTP in the Prometheus text format.
+
+# Set PROMETHEUS_MULTIPROC_DIR in the process environment (not .env) when the
+# webapp runs under several Gunicorn workers so /metrics aggregates all of them.
+PROMETHEUS_MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+
+# --- Histogram Buckets ---
+# Request / transfer latency in seconds (large files can take minutes)
+LATENCY_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    30,
+    60,
+    120,
+    300,
+    600,
+)
+# SQLite calls are expected to finish in well under a second
+DB_LATENCY_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    5,
+)
+# Transfer throughput in bytes/sec (64 KiB/s .. 1 GiB/s)
+THROUGHPUT_BUCKETS = tuple(64 * 1024 * 4**i for i in range(8))
+# Pipeline delays in seconds (upload -> notification, upload -> NAS)
+DELAY_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600, 7200, 21600, 86400)
+
+logger = logging.getLogger("metrics")
+
+
+def render_latest():
+    """Returns the current metrics payload and its content type."""
+    if PROMETHEUS_MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+def start_metrics_server(port):
+    """Starts a background HTTP server exposing /metrics. A port <= 0 disables it."""
+    if port <= 0:
+        logger.info("Metrics server disabled.")
+        return False
+    try:
+        start_http_server(port)
+    except OSError as e:
+        logger.error(f"Failed to start metrics server on port {port}: {e}")
+        return False
+    logger.info(f"Metrics server listening on port {port}")
+    return True
+
+
+def observe_transfer(latency, throughput, bytes_total, num_bytes, seconds):
+    """Records a completed transfer in its latency, throughput and byte metrics."""
+    latency.observe(seconds)
+    if num_bytes:
+        bytes_total.inc(num_bytes)
+        if seconds > 0:
+            throughput.observe(num_bytes / seconds)
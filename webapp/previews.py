@@ -0,0 +1,226 @@
+import os
+import logging
+import mimetypes
+import threading
+import subprocess
+import importlib.util
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor
+import webapp.database as db
+import webapp.tracing as tracing
+
+# Image thumbnails are skipped without Pillow. It is only imported for the
+# first thumbnail, so processes that never make one do not pay for it.
+HAVE_PILLOW = importlib.util.find_spec("PIL") is not None
+
+# Derivative (preview) generation shared by the webapp and uploader.
+# The webapp queues a preview right after an upload is committed; the uploader
+# sweeps up anything that was missed (e.g. the webapp restarted mid-way).
+# Previews live in their own directory, capped at PREVIEW_CACHE_MAX_BYTES.
+
+PREVIEW_DIR = os.path.abspath(os.getenv("PREVIEW_DIR", "../data/previews"))
+PREVIEW_WORKERS = int(os.getenv("PREVIEW_WORKERS", 2))
+PREVIEW_CACHE_MAX_BYTES = int(os.getenv("PREVIEW_CACHE_MAX_BYTES", 512 * 1024**2))
+PREVIEW_MAX_DIMENSION = int(os.getenv("PREVIEW_MAX_DIMENSION", 320))
+PREVIEW_TEXT_CHARS = int(os.getenv("PREVIEW_TEXT_CHARS", 500))
+FFMPEG_PATH = os.getenv("FFMPEG_PATH", "ffmpeg")
+FFMPEG_TIMEOUT_SECONDS = 30
+# A 'pending' claim older than this is assumed abandoned and may be retried
+STALE_CLAIM_SECONDS = 600
+
+# fmt: off
+TEXT_EXTENSIONS = {
+    ".txt", ".md", ".log", ".csv", ".json", ".xml", ".yaml", ".yml", ".ini",
+    ".py", ".js", ".ts", ".java", ".c", ".h", ".cpp", ".rs", ".go", ".sh",
+}
+# fmt: on
+
+logger = logging.getLogger("previews")
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def preview_kind(original_filename, content_type):
+    """Returns 'image', 'video', 'text' or None for an upload."""
+    guessed, _ = mimetypes.guess_type(original_filename or "")
+    for mime in (content_type, guessed):
+        if not mime or mime == "application/octet-stream":
+            continue
+        if mime.startswith("image/"):
+            return "image"
+        if mime.startswith("video/"):
+            return "video"
+        if mime.startswith("text/") or mime == "application/json":
+            return "text"
+    if os.path.splitext(original_filename or "")[1].lower() in TEXT_EXTENSIONS:
+        return "text"
+    return None
+
+
+# --- Derivative Builders ---
+
+
+def _make_thumbnail(source_path, target_path):
+    from PIL import Image, ImageOps
+
+    with Image.open(source_path) as img:
+        # Let the JPEG decoder downscale while reading instead of decoding full size
+        img.draft("RGB", (PREVIEW_MAX_DIMENSION, PREVIEW_MAX_DIMENSION))
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail((PREVIEW_MAX_DIMENSION, PREVIEW_MAX_DIMENSION))
+        img.convert("RGB").save(target_path, "JPEG", quality=80, optimize=True)
+
+
+def _make_poster_frame(source_path, target_path):
+    # Seek before opening the input so ffmpeg only decodes around the frame;
+    # retry from the start for clips shorter than a second.
+    for offset in ("1", "0"):
+        # fmt: off
+        command = [
+            FFMPEG_PATH, "-nostdin", "-loglevel", "error", "-y",
+            "-ss", offset, "-i", source_path, "-frames:v", "1",
+            "-vf", f"scale={PREVIEW_MAX_DIMENSION}:{PREVIEW_MAX_DIMENSION}"
+            ":force_original_aspect_ratio=decrease", target_path,
+        ]
+        # fmt: on
+        result = subprocess.run(
+            command, capture_output=True, timeout=FFMPEG_TIMEOUT_SECONDS
+        )
+        if result.returncode == 0 and os.path.exists(target_path):
+            return
+    raise RuntimeError(f"ffmpeg failed: {result.stderr.decode(errors='replace')}")
+
+
+def _make_text_preview(source_path):
+    # Read a little more than needed so multi-byte characters are not cut off
+    with open(source_path, "rb") as f:
+        head = f.read(PREVIEW_TEXT_CHARS * 4)
+    text = head.decode("utf-8", errors="replace")[:PREVIEW_TEXT_CHARS]
+    return text.replace("\x00", "")
+
+
+def generate_preview(file_id, cached_path, original_filename, content_type):
+    """Builds the preview for one upload and records it. Returns the final status."""
+    stale_before = datetime.now(timezone.utc) - timedelta(seconds=STALE_CLAIM_SECONDS)
+    if not db.claim_preview(file_id, stale_before):
+        return None  # Already done, or another worker is on it
+
+    kind = preview_kind(original_filename, content_type)
+    if kind is None or (kind == "image" and not HAVE_PILLOW):
+        db.finish_preview(file_id, "unsupported")
+        return "unsupported"
+    if not cached_path or not os.path.exists(cached_path):
+        db.finish_preview(file_id, "error")
+        return "error"
+
+    target_path = os.path.join(PREVIEW_DIR, f"{file_id}.jpg")
+    try:
+        with tracing.span("preview.generate", file_id=file_id, kind=kind):
+            if kind == "text":
+                text = _make_text_preview(cached_path)
+                db.finish_preview(
+                    file_id,
+                    "ready",
+                    kind="text",
+                    content_type="text/plain; charset=utf-8",
+                    text=text,
+                )
+                return "ready"
+            os.makedirs(PREVIEW_DIR, exist_ok=True)
+            if kind == "image":
+                _make_thumbnail(cached_path, target_path)
+            else:
+                _make_poster_frame(cached_path, target_path)
+    except Exception as e:
+        logger.warning(f"Could not build {kind} preview for {file_id}: {e}")
+        if os.path.exists(target_path):
+            os.remove(target_path)
+        db.finish_preview(file_id, "error")
+        return "error"
+
+    db.finish_preview(
+        file_id,
+        "ready",
+        kind="image",
+        path=target_path,
+        content_type="image/jpeg",
+        size=os.path.getsize(target_path),
+    )
+    enforce_cache_limit()
+    return "ready"
+
+
+def enforce_cache_limit():
+    """Evicts the oldest preview images until the cache fits PREVIEW_CACHE_MAX_BYTES."""
+    if PREVIEW_CACHE_MAX_BYTES <= 0:
+        return 0
+    evicted = 0
+    while True:
+        excess = db.get_preview_cache_bytes() - PREVIEW_CACHE_MAX_BYTES
+        if excess <= 0:
+            break
+        oldest = db.get_oldest_previews(limit=50)
+        evicted_before = evicted
+        for preview in oldest:
+            if excess <= 0:
+                break  # Only evict as much as needed to get back under the limit
+            try:
+                os.remove(preview["path"])
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.error(f"Error evicting preview {preview['path']}: {e}")
+                continue
+            db.mark_preview_evicted(preview["file_id"])
+            evicted += 1
+            excess -= preview["size"]
+        if evicted == evicted_before:
+            break  # Nothing left that can be evicted
+    if evicted:
+        logger.info(f"Evicted {evicted} preview(s) to stay within the cache limit.")
+    return evicted
+
+
+# --- Worker Pool ---
+
+
+def _run(file_id, cached_path, original_filename, content_type):
+    try:
+        generate_preview(file_id, cached_path, original_filename, content_type)
+    except Exception as e:
+        logger.error(f"Preview worker failed for {file_id}: {e}", exc_info=True)
+
+
+def submit(file_id, cached_path, original_filename, content_type):
+    """Queues preview generation on the background worker pool."""
+    global _executor
+    if PREVIEW_WORKERS <= 0:
+        return
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=PREVIEW_WORKERS, thread_name_prefix="preview"
+            )
+    _executor.submit(_run, file_id, cached_path, original_filename, content_type)
+
+
+def generate_pending_previews(limit=200):
+    """Builds previews for uploads that do not have one yet using the worker pool."""
+    stale_before = datetime.now(timezone.utc) - timedelta(seconds=STALE_CLAIM_SECONDS)
+    pending = db.get_uploads_without_preview(stale_before, limit)
+    if not pending:
+        return 0
+    logger.info(f"Generating previews for {len(pending)} upload(s)...")
+    with ThreadPoolExecutor(
+        max_workers=max(1, PREVIEW_WORKERS), thread_name_prefix="preview"
+    ) as pool:
+        for record in pending:
+            pool.submit(
+                _run,
+                record["file_id"],
+                record["cached_path"],
+                record["original_filename"],
+                record["content_type"],
+            )
+    return len(pending)
@@ -0,0 +1,284 @@
+import os
+import time
+import uuid
+import random
+import sqlite3
+import logging
+import threading
+from prometheus_client import Counter
+import webapp.database as db
+
+# Download bandwidth shaping for the webapp, shared by all of its workers.
+# Token buckets (per file_id, per client IP and global) and the list of open
+# streams live in a small SQLite database of their own (RATE_LIMIT_DB_PATH),
+# so Gunicorn workers enforce the same limits without adding writes to the
+# metadata database. A stream takes tokens once per RATE_LIMIT_QUANTUM_BYTES
+# sent; a bucket may go into debt, and the stream sleeps until it is repaid.
+# Any limit set to 0 is disabled; with all of them disabled downloads are
+# served exactly as before (including sendfile).
+
+DOWNLOAD_RATE_GLOBAL = int(os.getenv("DOWNLOAD_RATE_GLOBAL", 0))  # bytes/sec
+DOWNLOAD_RATE_PER_IP = int(os.getenv("DOWNLOAD_RATE_PER_IP", 0))  # bytes/sec
+DOWNLOAD_RATE_PER_FILE = int(os.getenv("DOWNLOAD_RATE_PER_FILE", 0))  # bytes/sec
+# Bucket size, in seconds of the rate: how far a quiet key may burst
+DOWNLOAD_BURST_SECONDS = float(os.getenv("DOWNLOAD_BURST_SECONDS", 2))
+DOWNLOAD_MAX_STREAMS_PER_IP = int(os.getenv("DOWNLOAD_MAX_STREAMS_PER_IP", 0))
+RATE_LIMIT_DB_PATH = os.getenv(
+    "RATE_LIMIT_DB_PATH",
+    os.path.join(os.path.dirname(db.DATABASE_PATH), "ratelimit.db"),
+)
+RATE_LIMIT_QUANTUM_BYTES = 256 * 1024
+# A stream whose process stopped updating it for this long is assumed dead
+STREAM_STALE_SECONDS = 120
+# How often each process refreshes the heartbeat of its open streams
+STREAM_HEARTBEAT_SECONDS = STREAM_STALE_SECONDS / 4
+# Buckets untouched for this long are full again and can be dropped
+BUCKET_IDLE_SECONDS = 3600
+
+ENABLED = bool(
+    DOWNLOAD_RATE_GLOBAL
+    or DOWNLOAD_RATE_PER_IP
+    or DOWNLOAD_RATE_PER_FILE
+    or DOWNLOAD_MAX_STREAMS_PER_IP
+)
+
+logger = logging.getLogger("ratelimit")
+
+THROTTLE_SECONDS = Counter(
+    "webapp_download_throttle_seconds_total",
+    "Time download streams spent waiting for bandwidth tokens.",
+)
+
+_init_lock = threading.Lock()
+_initialized_pid = None
+
+# Stream IDs open in this process, kept alive by the heartbeat thread
+_open_streams = set()
+_open_streams_lock = threading.Lock()
+_heartbeat_pid = None
+
+
+def _connect():
+    # A stream's connection may be closed by a different thread than opened it
+    conn = sqlite3.connect(
+        RATE_LIMIT_DB_PATH, timeout=5, isolation_level=None, check_same_thread=False
+    )
+    # The state is short-lived; losing it in a power cut only resets the limits
+    conn.execute("PRAGMA synchronous=OFF")
+    return conn
+
+
+def _init():
+    global _initialized_pid
+    if _initialized_pid == os.getpid():
+        return
+    with _init_lock:
+        if _initialized_pid == os.getpid():
+            return
+        os.makedirs(os.path.dirname(RATE_LIMIT_DB_PATH) or ".", exist_ok=True)
+        conn = _connect()
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS buckets (
+                    key TEXT PRIMARY KEY,
+                    tokens REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS streams (
+                    stream_id TEXT PRIMARY KEY,
+                    client_ip TEXT NOT NULL,
+                    heartbeat REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS idx_streams_ip ON streams (client_ip);
+            """
+            )
+        finally:
+            conn.close()
+        _initialized_pid = os.getpid()
+
+
+def _refresh_heartbeats():
+    """Marks every stream open in this process as alive."""
+    with _open_streams_lock:
+        stream_ids = list(_open_streams)
+    if not stream_ids:
+        return
+    now = time.time()
+    conn = _connect()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.executemany(
+            "UPDATE streams SET heartbeat = ? WHERE stream_id = ?",
+            [(now, stream_id) for stream_id in stream_ids],
+        )
+        conn.execute("COMMIT")
+    except sqlite3.Error as e:
+        logger.error(f"Rate limiter error refreshing streams: {e}")
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+    finally:
+        conn.close()
+
+
+def _heartbeat_loop():
+    while True:
+        time.sleep(STREAM_HEARTBEAT_SECONDS)
+        _refresh_heartbeats()
+
+
+def _start_heartbeat():
+    # The heartbeat runs on a timer, not per chunk: a client that stops reading
+    # blocks its worker in send, and must keep holding its slot meanwhile.
+    # Threads do not survive fork, so each worker process starts its own.
+    global _heartbeat_pid
+    if _heartbeat_pid == os.getpid():
+        return
+    with _open_streams_lock:
+        if _heartbeat_pid == os.getpid():
+            return
+        _open_streams.clear()  # Inherited from the parent, which still owns them
+        threading.Thread(
+            target=_heartbeat_loop, name="ratelimit-heartbeat", daemon=True
+        ).start()
+        _heartbeat_pid = os.getpid()
+
+
+class Stream:
+    """One shaped download: charges the buckets and holds a per-IP stream slot."""
+
+    def __init__(self, conn, stream_id, file_id, client_ip):
+        self.conn = conn
+        self.stream_id = stream_id
+        self.buckets = [
+            (key, rate)
+            for key, rate in (
+                ("global", DOWNLOAD_RATE_GLOBAL),
+                (f"ip:{client_ip}", DOWNLOAD_RATE_PER_IP),
+                (f"file:{file_id}", DOWNLOAD_RATE_PER_FILE),
+            )
+            if rate > 0
+        ]
+        self.closed = False
+        if DOWNLOAD_MAX_STREAMS_PER_IP:
+            _start_heartbeat()
+            with _open_streams_lock:
+                _open_streams.add(stream_id)
+
+    def acquire(self, num_bytes, wait=True):
+        """Takes num_bytes from every bucket, sleeping off any debt if wait is set."""
+        if not self.buckets:
+            return 0
+        now = time.time()
+        delay = 0
+        try:
+            self.conn.execute("BEGIN IMMEDIATE")
+            for key, rate in self.buckets:
+                burst = rate * DOWNLOAD_BURST_SECONDS
+                row = self.conn.execute(
+                    "SELECT tokens, updated_at FROM buckets WHERE key = ?", (key,)
+                ).fetchone()
+                tokens = burst if row is None else row[0] + (now - row[1]) * rate
+                tokens = min(burst, tokens) - num_bytes
+                self.conn.execute(
+                    """INSERT INTO buckets (key, tokens, updated_at) VALUES (?, ?, ?)
+                       ON CONFLICT (key) DO UPDATE SET tokens = excluded.tokens,
+                                                       updated_at = excluded.updated_at""",
+                    (key, tokens, now),
+                )
+                if tokens < 0:
+                    delay = max(delay, -tokens / rate)
+            self.conn.execute("COMMIT")
+        except sqlite3.Error as e:
+            # Fail open: a broken limiter must not break downloads
+            logger.error(f"Rate limiter error: {e}")
+            if self.conn.in_transaction:
+                self.conn.execute("ROLLBACK")
+            return 0
+        if wait and delay > 0:
+            THROTTLE_SECONDS.inc(delay)
+            time.sleep(delay)
+        return delay
+
+    def close(self):
+        """Releases the stream slot."""
+        if self.closed:
+            return
+        self.closed = True
+        with _open_streams_lock:
+            _open_streams.discard(self.stream_id)
+        try:
+            self.conn.execute(
+                "DELETE FROM streams WHERE stream_id = ?", (self.stream_id,)
+            )
+        except sqlite3.Error as e:
+            logger.error(f"Rate limiter error releasing stream: {e}")
+        finally:
+            self.conn.close()
+
+
+def open_stream(file_id, client_ip):
+    """Starts a shaped download. Returns None if client_ip already has
+    DOWNLOAD_MAX_STREAMS_PER_IP downloads open."""
+    _init()
+    conn = _connect()
+    stream_id = uuid.uuid4().hex
+    now = time.time()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        if random.random() < 0.01:
+            conn.execute(
+                "DELETE FROM buckets WHERE updated_at < ?",
+                (now - BUCKET_IDLE_SECONDS,),
+            )
+        if DOWNLOAD_MAX_STREAMS_PER_IP:
+            conn.execute(
+                "DELETE FROM streams WHERE client_ip = ? AND heartbeat < ?",
+                (client_ip, now - STREAM_STALE_SECONDS),
+            )
+            (open_count,) = conn.execute(
+                "SELECT COUNT(*) FROM streams WHERE client_ip = ?", (client_ip,)
+            ).fetchone()
+            if open_count >= DOWNLOAD_MAX_STREAMS_PER_IP:
+                conn.execute("ROLLBACK")
+                conn.close()
+                return None
+            conn.execute(
+                "INSERT INTO streams (stream_id, client_ip, heartbeat) VALUES (?, ?, ?)",
+                (stream_id, client_ip, now),
+            )
+        conn.execute("COMMIT")
+    except sqlite3.Error as e:
+        logger.error(f"Rate limiter error opening stream: {e}")
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+    return Stream(conn, stream_id, file_id, client_ip)
+
+
+class ShapedBody:
+    """Wraps a response body so it is sent within the stream's limits."""
+
+    def __init__(self, body, stream):
+        self.body = body
+        self.stream = stream
+        self.unpaid = 0
+
+    def __iter__(self):
+        for chunk in self.body:
+            yield chunk
+            # Pay after sending, so small files are not delayed by a whole quantum
+            self.unpaid += len(chunk)
+            if self.unpaid >= RATE_LIMIT_QUANTUM_BYTES:
+                self.stream.acquire(self.unpaid)
+                self.unpaid = 0
+
+    def close(self):
+        try:
+            if self.unpaid:
+                self.stream.acquire(self.unpaid, wait=False)
+                self.unpaid = 0
+            if hasattr(self.body, "close"):
+                self.body.close()
+        finally:
+            self.stream.close()
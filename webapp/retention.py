@@ -0,0 +1,184 @@
+import os
+import logging
+from datetime import datetime, timedelta, timezone
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from prometheus_client import Counter
+import webapp.database as db
+import webapp.tracing as tracing
+
+# Retention policy engine, run periodically by the uploader.
+# Expiring happens in two steps so a crash never leaves files nobody tracks:
+#   1. expire_old_uploads() moves matching uploads to expired_uploads in bounded
+#      batches (one short transaction each); /download answers 410 from then on.
+#   2. purge_expired() deletes the cached, preview and NAS copies, and marks
+#      each expired upload purged once all of its files are gone.
+#
+# Rules (days; 0 keeps forever) are matched in this order:
+#   RETENTION_CHANNEL_DAYS  "channel_id:days,..." - applies to every upload in the channel
+#   RETENTION_SIZE_DAYS     "min_bytes:days,..."  - uploads of at least min_bytes
+#                                                   (the largest matching threshold wins)
+#   RETENTION_DEFAULT_DAYS  everything else
+
+RETENTION_DEFAULT_DAYS = int(os.getenv("RETENTION_DEFAULT_DAYS", 0))
+RETENTION_CHANNEL_DAYS = os.getenv("RETENTION_CHANNEL_DAYS", "")
+RETENTION_SIZE_DAYS = os.getenv("RETENTION_SIZE_DAYS", "")
+RETENTION_BATCH_SIZE = int(os.getenv("RETENTION_BATCH_SIZE", 500))
+RETENTION_DELETE_WORKERS = int(os.getenv("RETENTION_DELETE_WORKERS", 4))
+
+logger = logging.getLogger("retention")
+
+EXPIRED_TOTAL = Counter(
+    "retention_expired_uploads_total", "Uploads expired by the retention policy."
+)
+PURGED_FILES_TOTAL = Counter(
+    "retention_purged_files_total",
+    "Stored files deleted for expired uploads.",
+    ["location", "outcome"],
+)
+
+RetentionRule = namedtuple(
+    "RetentionRule",
+    ["name", "days", "channel_id", "exclude_channel_ids", "min_size", "max_size"],
+)
+
+
+def _parse_pairs(value, setting):
+    """Parses 'key:days,key:days' into a {int key: int days} dict."""
+    pairs = {}
+    for item in value.split(","):
+        if not item.strip():
+            continue
+        try:
+            key, days = item.split(":")
+            pairs[int(key)] = int(days)
+        except ValueError:
+            logger.error(f"Ignoring invalid {setting} entry: '{item.strip()}'")
+    return pairs
+
+
+def build_rules():
+    """Turns the RETENTION_* settings into non-overlapping rules to expire by."""
+    channel_days = _parse_pairs(RETENTION_CHANNEL_DAYS, "RETENTION_CHANNEL_DAYS")
+    size_days = _parse_pairs(RETENTION_SIZE_DAYS, "RETENTION_SIZE_DAYS")
+    # Channels with a rule of their own (including 'keep forever') are left
+    # out of the size and default rules
+    ruled_channels = tuple(channel_days)
+
+    rules = [
+        RetentionRule(f"channel {channel_id}", days, channel_id, (), None, None)
+        for channel_id, days in channel_days.items()
+    ]
+    upper = None
+    for min_size in sorted(size_days, reverse=True):
+        rules.append(
+            RetentionRule(
+                f"size >= {min_size}",
+                size_days[min_size],
+                None,
+                ruled_channels,
+                min_size,
+                upper,
+            )
+        )
+        upper = min_size
+    rules.append(
+        RetentionRule(
+            "default", RETENTION_DEFAULT_DAYS, None, ruled_channels, None, upper
+        )
+    )
+    return [rule for rule in rules if rule.days > 0]
+
+
+def expire_old_uploads(rules=None):
+    """Expires uploads past their retention in batches of RETENTION_BATCH_SIZE."""
+    total = 0
+    now = datetime.now(timezone.utc)
+    for rule in build_rules() if rules is None else rules:
+        cutoff = now - timedelta(days=rule.days)
+        while True:
+            with tracing.span("retention.expire_batch", rule=rule.name):
+                expired = db.expire_uploads(
+                    cutoff,
+                    RETENTION_BATCH_SIZE,
+                    channel_id=rule.channel_id,
+                    exclude_channel_ids=rule.exclude_channel_ids,
+                    min_size=rule.min_size,
+                    max_size=rule.max_size,
+                )
+            if not expired:
+                break
+            total += expired
+            EXPIRED_TOTAL.inc(expired)
+            logger.info(f"Expired {expired} upload(s) under rule '{rule.name}'.")
+            if expired < RETENTION_BATCH_SIZE:
+                break
+    return total
+
+
+# --- Purging Stored Files ---
+
+
+def _delete_local(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    return True
+
+
+def _purge_one(backend, record):
+    """Deletes every stored copy of one expired upload. Returns True when all are gone."""
+    purged = True
+    for location, path in (
+        ("cache", record["cached_path"]),
+        ("preview", record["preview_path"]),
+        ("nas", record["nas_path"]),
+    ):
+        if not path:
+            continue
+        if location == "nas" and backend is None:
+            PURGED_FILES_TOTAL.labels(location, "deferred").inc()
+            purged = False
+            continue
+        try:
+            if location == "nas":
+                backend.delete(path)
+            else:
+                _delete_local(path)
+            PURGED_FILES_TOTAL.labels(location, "deleted").inc()
+        except Exception as e:
+            logger.error(f"Error deleting {location} copy {path}: {e}")
+            PURGED_FILES_TOTAL.labels(location, "error").inc()
+            purged = False
+    return purged
+
+
+def purge_expired(backend=None):
+    """Deletes the stored files of expired uploads, RETENTION_DELETE_WORKERS at a time.
+
+    NAS copies are deleted through backend (a webapp.storage backend, created
+    with pool_size=RETENTION_DELETE_WORKERS); without one they are kept for the
+    next run.
+    """
+    total = 0
+    after = None  # Keyset cursor, so records that failed are skipped until the next run
+    with ThreadPoolExecutor(
+        max_workers=max(1, RETENTION_DELETE_WORKERS), thread_name_prefix="retention"
+    ) as pool:
+        while True:
+            pending = db.get_unpurged_expired(RETENTION_BATCH_SIZE, after=after)
+            if not pending:
+                break
+            results = pool.map(lambda record: _purge_one(backend, record), pending)
+            done = [
+                record["file_id"] for record, purged in zip(pending, results) if purged
+            ]
+            if done and db.mark_expired_purged(done):
+                total += len(done)
+            if len(pending) < RETENTION_BATCH_SIZE:
+                break
+            after = (pending[-1]["expired_at"], pending[-1]["row_id"])
+    if total:
+        logger.info(f"Purged stored files of {total} expired upload(s).")
+    return total
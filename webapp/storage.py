@@ -0,0 +1,309 @@
+import os
+import errno
+import shutil
+import logging
+import webapp.tracing as tracing
+
+try:
+    import fcntl
+except ImportError:  # Not available on Windows; reflinks are skipped there
+    fcntl = None
+
+# Storage backends for the NAS ("archive") copy of an upload, shared by the
+# uploader (store / delete) and the webapp's download fallback (open).
+# Paths handed to a backend are relative to the NAS share, e.g.
+# "DiscordUploads/<file_id>_<name>", and are what uploads.nas_path records.
+#
+#   NAS_BACKEND=webdav  Upload over HTTP with WebDAV (the default)
+#   NAS_BACKEND=local   The NAS share is mounted on this host (NFS/SMB) at
+#                       NAS_LOCAL_PATH; files are moved/copied with zero-copy
+#                       primitives where the filesystems allow it
+
+NAS_BACKEND = os.getenv("NAS_BACKEND", "webdav").lower()
+NAS_WEBDAV_URL = os.getenv("NAS_WEBDAV_URL")
+NAS_WEBDAV_USER = os.getenv("NAS_WEBDAV_USER")
+NAS_WEBDAV_PASS = os.getenv("NAS_WEBDAV_PASS")
+NAS_LOCAL_PATH = os.getenv("NAS_LOCAL_PATH")
+NAS_TARGET_FOLDER = os.getenv("NAS_TARGET_FOLDER", "/DiscordUploads").strip(
+    "/"
+)  # Ensure no leading/trailing slashes initially
+
+# Buffer size for the buffered copy fallback
+COPY_BUFFER_BYTES = 1024 * 1024
+FICLONE = 0x40049409  # ioctl request for a reflink (Btrfs, XFS, NFS 4.2, ...)
+# errno values meaning "this copy method is not possible here", not a failure
+_UNSUPPORTED_ERRNOS = {
+    errno.EXDEV,
+    errno.EINVAL,
+    errno.ENOSYS,
+    errno.ENOTTY,
+    errno.EOPNOTSUPP,
+    errno.EBADF,
+    errno.EPERM,
+}
+
+logger = logging.getLogger("storage")
+
+
+class StorageBackend:
+    """Interface for where uploads are archived once they leave the cache."""
+
+    name = None
+
+    def prepare(self):
+        """Checks the backend is usable and creates NAS_TARGET_FOLDER. Returns a bool."""
+        raise NotImplementedError
+
+    def store(self, local_path, remote_path, move=False):
+        """Copies (or, with move=True, moves) a cached file into storage."""
+        raise NotImplementedError
+
+    def delete(self, remote_path):
+        """Deletes a stored file. A file that is already gone is not an error."""
+        raise NotImplementedError
+
+    def open(self, remote_path):
+        """Returns a readable binary file object for a stored file."""
+        raise NotImplementedError
+
+    def exists(self, remote_path):
+        """Whether a file is stored at remote_path."""
+        raise NotImplementedError
+
+    def local_path(self, remote_path):
+        """Returns a filesystem path for a stored file if it has one, else None."""
+        return None
+
+
+# --- WebDAV Backend ---
+
+
+class WebDAVBackend(StorageBackend):
+    """Stores files on the NAS over WebDAV.
+
+    pool_size sets how many keep-alive connections the client keeps, so one
+    backend can be shared by that many threads.
+    """
+
+    name = "webdav"
+
+    def __init__(self, url, user, password, pool_size=1):
+        from webdav3.client import Client
+        from requests.adapters import HTTPAdapter
+
+        self.client = Client(
+            {
+                "webdav_hostname": url,
+                "webdav_login": user,
+                "webdav_password": password,
+                # Add other options if needed, e.g., cert verification path
+                # 'webdav_cert_path': '/path/to/cert'
+            }
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(1, pool_size))
+        self.client.session.mount("http://", adapter)
+        self.client.session.mount("https://", adapter)
+
+    def prepare(self):
+        try:
+            with tracing.span("webdav.is_dir", remote_path=NAS_TARGET_FOLDER):
+                base_exists = self.client.is_dir(NAS_TARGET_FOLDER)
+        except Exception as e:
+            from webdav3.exceptions import RemoteResourceNotFound
+
+            if not isinstance(e, RemoteResourceNotFound):
+                logger.error(f"Failed to reach WebDAV server: {e}", exc_info=True)
+                return False
+            base_exists = False
+        if base_exists:
+            return True
+        logger.info(
+            f"Base NAS target folder '{NAS_TARGET_FOLDER}' not found, attempting to create."
+        )
+        try:
+            with tracing.span("webdav.mkdir", remote_path=NAS_TARGET_FOLDER):
+                self.client.mkdir(NAS_TARGET_FOLDER)
+        except Exception as e:
+            logger.error(f"Failed to create base NAS folder '{NAS_TARGET_FOLDER}': {e}")
+            return False
+        logger.info(f"Created base NAS folder: {NAS_TARGET_FOLDER}")
+        return True
+
+    def store(self, local_path, remote_path, move=False):
+        with tracing.span("webdav.upload_sync", remote_path=remote_path):
+            self.client.upload_sync(remote_path=remote_path, local_path=local_path)
+        if move:
+            os.remove(local_path)
+
+    def exists(self, remote_path):
+        with tracing.span("webdav.check", remote_path=remote_path):
+            return self.client.check(remote_path)
+
+    def delete(self, remote_path):
+        from webdav3.urn import Urn
+        from webdav3.exceptions import RemoteResourceNotFound
+
+        try:
+            with tracing.span("webdav.clean", remote_path=remote_path):
+                response = self.client.execute_request(
+                    action="clean", path=Urn(remote_path).quote()
+                )
+                response.content  # Drain the body so the connection returns to the pool
+        except RemoteResourceNotFound:
+            pass  # Already gone
+
+    def open(self, remote_path):
+        from webdav3.urn import Urn
+        from webdav3.exceptions import RemoteResourceNotFound
+
+        try:
+            with tracing.span("webdav.download", remote_path=remote_path):
+                response = self.client.execute_request(
+                    action="download", path=Urn(remote_path).quote()
+                )
+        except RemoteResourceNotFound:
+            raise FileNotFoundError(remote_path)
+        response.raw.decode_content = True
+        # The body is read while the response streams; time those reads on their own
+        return tracing.TimedReader(response.raw, "webdav.read", remote_path=remote_path)
+
+
+# --- Local Filesystem Backend ---
+
+
+def _reflink(src, dst):
+    fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+
+
+def _copy_file_range(src, dst):
+    size = os.fstat(src.fileno()).st_size
+    copied = 0
+    while copied < size:
+        sent = os.copy_file_range(src.fileno(), dst.fileno(), size - copied)
+        if sent == 0:
+            # Some filesystems report success without copying anything; let
+            # copy_file() fall back to a buffered copy instead of a short file
+            raise OSError(
+                errno.EINVAL,
+                f"copy_file_range stopped after {copied} of {size} bytes",
+            )
+        copied += sent
+
+
+def _buffered_copy(src, dst):
+    shutil.copyfileobj(src, dst, COPY_BUFFER_BYTES)
+
+
+def copy_file(source_path, target_path):
+    """Copies a file using the cheapest method the filesystems support.
+
+    Tries a reflink (shares the data blocks), then copy_file_range (copies
+    inside the kernel, or on the server for NFS 4.2 / SMB3), then a plain
+    buffered copy. Returns the name of the method that worked.
+    """
+    methods = []
+    if fcntl is not None:
+        methods.append(("reflink", _reflink))
+    if hasattr(os, "copy_file_range"):
+        methods.append(("copy_file_range", _copy_file_range))
+    methods.append(("buffered", _buffered_copy))
+
+    with open(source_path, "rb") as src, open(target_path, "wb") as dst:
+        for method, copy in methods:
+            try:
+                copy(src, dst)
+            except OSError as e:
+                if method == "buffered" or e.errno not in _UNSUPPORTED_ERRNOS:
+                    raise
+                # Start the next method from a clean slate
+                src.seek(0)
+                dst.seek(0)
+                dst.truncate()
+                continue
+            dst.flush()
+            os.fsync(dst.fileno())
+            return method
+
+
+class LocalBackend(StorageBackend):
+    """Stores files in a directory, typically a NAS share mounted on this host."""
+
+    name = "local"
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+
+    def local_path(self, remote_path):
+        path = os.path.abspath(os.path.join(self.root, remote_path.lstrip("/")))
+        if os.path.commonpath([self.root, path]) != self.root:
+            raise ValueError(f"Path escapes the storage root: {remote_path}")
+        return path
+
+    def prepare(self):
+        if not os.path.isdir(self.root):
+            logger.error(f"NAS_LOCAL_PATH '{self.root}' is not a directory.")
+            return False
+        try:
+            os.makedirs(self.local_path(NAS_TARGET_FOLDER), exist_ok=True)
+        except OSError as e:
+            logger.error(f"Failed to create base NAS folder '{NAS_TARGET_FOLDER}': {e}")
+            return False
+        return True
+
+    def store(self, local_path, remote_path, move=False):
+        target_path = self.local_path(remote_path)
+        with tracing.span("local.store", remote_path=remote_path, move=move) as span:
+            if move:
+                try:
+                    os.rename(local_path, target_path)
+                    span.attrs["method"] = "rename"
+                    return
+                except OSError as e:
+                    if e.errno != errno.EXDEV:
+                        raise
+                    # Different filesystems: copy, then drop the cached copy
+            # Write under a temporary name so a partial file is never visible
+            partial_path = f"{target_path}.part"
+            try:
+                span.attrs["method"] = copy_file(local_path, partial_path)
+                os.replace(partial_path, target_path)
+            except BaseException:
+                if os.path.exists(partial_path):
+                    os.remove(partial_path)
+                raise
+            if move:
+                os.remove(local_path)
+
+    def delete(self, remote_path):
+        try:
+            os.remove(self.local_path(remote_path))
+        except FileNotFoundError:
+            pass
+
+    def open(self, remote_path):
+        return open(self.local_path(remote_path), "rb")
+
+    def exists(self, remote_path):
+        return os.path.isfile(self.local_path(remote_path))
+
+
+def get_backend(pool_size=1):
+    """Returns the storage backend selected by NAS_BACKEND, or None if it is not configured."""
+    if NAS_BACKEND == "local":
+        if not NAS_LOCAL_PATH:
+            logger.error("NAS_BACKEND is 'local' but NAS_LOCAL_PATH is not set.")
+            return None
+        return LocalBackend(NAS_LOCAL_PATH)
+    if NAS_BACKEND != "webdav":
+        logger.error(f"Unknown NAS_BACKEND: '{NAS_BACKEND}'")
+        return None
+    if not all([NAS_WEBDAV_URL, NAS_WEBDAV_USER, NAS_WEBDAV_PASS]):
+        logger.error("WebDAV credentials not fully configured in .env file.")
+        return None
+    try:
+        return WebDAVBackend(
+            NAS_WEBDAV_URL, NAS_WEBDAV_USER, NAS_WEBDAV_PASS, pool_size=pool_size
+        )
+    except Exception as e:
+        logger.error(f"Failed to initialize WebDAV client: {e}", exc_info=True)
+        return None
@@ -0,0 +1,247 @@
+import os
+import json
+import time
+import uuid
+import random
+import signal
+import logging
+import cProfile
+import functools
+import contextvars
+from contextlib import contextmanager
+
+# Lightweight request tracing shared by the webapp, database module and uploader.
+# A span measures one unit of work (a request, a database call, a WebDAV call);
+# spans nest per thread/task via contextvars. Spans slower than the threshold are
+# logged as one JSON line so they can be grepped or shipped to a log pipeline.
+
+SLOW_SPAN_THRESHOLD_MS = float(os.getenv("SLOW_SPAN_THRESHOLD_MS", 500))
+# Fraction of root spans (requests / uploader runs) to run under cProfile
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", 0))
+# Signal that toggles profiling at runtime (SIGUSR1 is taken by Gunicorn workers)
+PROFILE_TOGGLE_SIGNAL = os.getenv("PROFILE_TOGGLE_SIGNAL", "SIGUSR2")
+# Sample rate used while profiling has been switched on by that signal
+PROFILE_SIGNAL_SAMPLE_RATE = float(os.getenv("PROFILE_SIGNAL_SAMPLE_RATE", 0.1))
+PROFILE_DIR = os.path.abspath(os.getenv("PROFILE_DIR", "../data/profiles"))
+
+logger = logging.getLogger("trace")
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+_profile_rate = PROFILE_SAMPLE_RATE
+
+
+class Span:
+    """A single timed unit of work within a trace."""
+
+    __slots__ = (
+        "name",
+        "trace_id",
+        "parent",
+        "attrs",
+        "start",
+        "profiler",
+        "detached",
+    )
+
+    def __init__(self, name, trace_id, parent, attrs):
+        self.name = name
+        self.trace_id = trace_id
+        self.parent = parent
+        self.attrs = attrs
+        self.start = time.perf_counter()
+        self.profiler = None
+        self.detached = False
+
+
+def current_trace_id():
+    """Returns the trace ID of the active span, or None outside a trace."""
+    active = _current_span.get()
+    return active.trace_id if active else None
+
+
+def _log_slow_span(slow, duration_ms, error):
+    entry = {
+        "event": "slow_span",
+        "span": slow.name,
+        "duration_ms": round(duration_ms, 2),
+        "threshold_ms": SLOW_SPAN_THRESHOLD_MS,
+        "trace_id": slow.trace_id,
+        "parent": slow.parent.name if slow.parent else None,
+    }
+    if error:
+        entry["error"] = error
+    entry.update(slow.attrs)
+    logger.warning(json.dumps(entry, default=str))
+
+
+def _end_span(current, error=None):
+    duration_ms = (time.perf_counter() - current.start) * 1000
+    if current.profiler:
+        _stop_profiler(current.profiler, current)
+        current.profiler = None
+    if duration_ms >= SLOW_SPAN_THRESHOLD_MS:
+        _log_slow_span(current, duration_ms, error)
+
+
+@contextmanager
+def span(name, profile=False, **attrs):
+    """Times the enclosed block as a span, logging it if it exceeds the threshold.
+
+    A span opened outside any other span starts a new trace. Root spans opened
+    with profile=True (one per request) are eligible for sampled profiling.
+    """
+    parent = _current_span.get()
+    trace_id = parent.trace_id if parent else uuid.uuid4().hex[:16]
+    current = Span(name, trace_id, parent, attrs)
+    token = _current_span.set(current)
+    if profile and parent is None:
+        current.profiler = _start_profiler()
+    error = None
+    try:
+        yield current
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        _current_span.reset(token)
+        # A detached span is ended later by finish(), unless its block failed
+        if not current.detached or error:
+            _end_span(current, error)
+
+
+def detach(keep_profiler=True):
+    """Keeps the active span open past the end of its block, e.g. while a
+    response body is streamed after the view returns; end it with finish().
+
+    cProfile only sees the thread it was started on, so pass
+    keep_profiler=False when the work that follows runs on other threads.
+    """
+    current = _current_span.get()
+    if current is None:
+        return None
+    current.detached = True
+    if current.profiler and not keep_profiler:
+        _stop_profiler(current.profiler, current)
+        current.profiler = None
+    return current
+
+
+def finish(detached):
+    """Ends a span returned by detach()."""
+    if detached is not None:
+        _end_span(detached)
+
+
+def record(name, duration_ms, parent=None, **attrs):
+    """Reports a span whose time was measured by the caller, such as the
+    total time spent in many small reads, as a child of parent."""
+    if duration_ms < SLOW_SPAN_THRESHOLD_MS:
+        return
+    parent = parent or _current_span.get()
+    trace_id = parent.trace_id if parent else uuid.uuid4().hex[:16]
+    _log_slow_span(Span(name, trace_id, parent, attrs), duration_ms, None)
+
+
+class TimedReader:
+    """File-like wrapper that adds up the time spent in read() and reports
+    it as one span when closed, so slow storage can be told apart from a
+    slow client while a response body is streamed."""
+
+    def __init__(self, raw, name, **attrs):
+        self.raw = raw
+        self.name = name
+        self.attrs = attrs
+        self.parent = _current_span.get()
+        self.read_seconds = 0.0
+        self.bytes_read = 0
+        self.closed = False
+
+    def __getattr__(self, name):
+        return getattr(self.raw, name)
+
+    def read(self, *args):
+        start = time.perf_counter()
+        try:
+            data = self.raw.read(*args)
+        finally:
+            self.read_seconds += time.perf_counter() - start
+        self.bytes_read += len(data)
+        return data
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.raw.close()
+        finally:
+            record(
+                self.name,
+                self.read_seconds * 1000,
+                self.parent,
+                bytes_read=self.bytes_read,
+                **self.attrs,
+            )
+
+
+def traced(name=None, profile=False):
+    """Decorator form of span(); defaults to the function's name."""
+
+    def decorator(func):
+        span_name = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(span_name, profile=profile):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+# --- Sampling Profiler ---
+
+
+def _start_profiler():
+    if _profile_rate <= 0 or random.random() >= _profile_rate:
+        return None
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:  # Another profiler is already active in this process
+        return None
+    return profiler
+
+
+def _stop_profiler(profiler, root):
+    profiler.disable()
+    try:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        path = os.path.join(PROFILE_DIR, f"{root.name}-{root.trace_id}.prof")
+        profiler.dump_stats(path)
+        logger.info(f"Wrote profile for trace {root.trace_id} to {path}")
+    except OSError as e:
+        logger.error(f"Failed to write profile for trace {root.trace_id}: {e}")
+
+
+def _toggle_profiling(signum, frame):
+    global _profile_rate
+    if _profile_rate > 0:
+        _profile_rate = 0
+    else:
+        _profile_rate = PROFILE_SAMPLE_RATE or PROFILE_SIGNAL_SAMPLE_RATE
+    logger.info(f"Profiling sample rate set to {_profile_rate}")
+
+
+def install_profile_signal_handler():
+    """Lets PROFILE_TOGGLE_SIGNAL switch sampled profiling on and off at runtime."""
+    signum = getattr(signal, PROFILE_TOGGLE_SIGNAL, None)
+    if signum is None:
+        logger.warning(f"Unknown PROFILE_TOGGLE_SIGNAL: {PROFILE_TOGGLE_SIGNAL}")
+        return False
+    try:
+        signal.signal(signum, _toggle_profiling)
+    except ValueError:  # Not called from the main thread
+        return False
+    return True